@@ -0,0 +1,249 @@
+"""Benchmarks restarter against a fake Docker Engine API served on a Unix socket.
+
+    python -m bench [--engine threads|async] [--latency-ms N] [scenario ...]
+
+Each scenario (see `bench/scenarios.py`, e.g. `wide-100`) starts `main.py` against
+a fresh fake daemon, waits for the first periodic check, applies a disturbance and
+measures until restarter has handled every event and the containers have
+converged: running, healthy and started after their dependencies.
+"""
+
+import argparse
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+from bench import fake_docker, scenarios
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SAMPLE_EVERY = 0.1
+
+_SAMPLE = re.compile(r"^([a-z_]+)(\{.*\})? (\S+)$")
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def scrape(port):
+    """Returns the metrics exposed by restarter as {(name, labels): value}."""
+    with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics", timeout=1) as r:
+        text = r.read().decode()
+    samples = {}
+    for line in text.splitlines():
+        if m := _SAMPLE.match(line):
+            samples[(m.group(1), m.group(2) or "")] = float(m.group(3))
+    return samples
+
+
+def _total(samples, name, labels=""):
+    return sum(v for (n, l), v in samples.items() if n == name and labels in l)
+
+
+def _proc_status(pid):
+    with open(f"/proc/{pid}/status") as f:
+        fields = dict(line.split(":", 1) for line in f)
+    return int(fields["Threads"]), int(fields["VmRSS"].split()[0]) / 1024
+
+
+class Run:
+    def __init__(self, scenario, args):
+        self.scenario = scenario
+        self.args = args
+        self.daemon = fake_docker.Daemon(latency=args.latency_ms / 1000)
+        self.port = _free_port()
+
+    def _wait_ready(self, process, timeout=60):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError("restarter exited during startup.")
+            try:
+                samples = scrape(self.port)
+            except OSError:
+                samples = {}
+            if _total(
+                samples, "restarter_check_duration_seconds_count"
+            ) and self.daemon.calls.get("GET /events", 0):
+                return samples
+            time.sleep(SAMPLE_EVERY)
+        raise RuntimeError("restarter didn't complete its first check in time.")
+
+    def _settled(self, process, trigger):
+        if trigger.is_alive() or not self.daemon.drained():
+            return False
+        try:
+            samples = scrape(self.port)
+        except OSError:
+            return False
+        handled = _total(samples, "restarter_events_total")
+        return (
+            handled >= self.daemon.delivered
+            and not _total(samples, "restarter_pending_actions")
+            and self.scenario.converged(self.daemon)
+        )
+
+    def __call__(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            server = fake_docker.serve(self.daemon, os.path.join(tmp, "docker.sock"))
+            self.scenario.setup(self.daemon)
+            env = dict(
+                os.environ,
+                DOCKER_HOST=f"unix://{tmp}/docker.sock",
+                RESTARTER_ENGINE=self.args.engine,
+                RESTARTER_CHECK_EVERY_SECONDS=str(
+                    self.scenario.check_every or self.args.check_every
+                ),
+                RESTARTER_METRICS_PORT=str(self.port),
+                **self.scenario.env,
+            )
+            if self.scenario.check_every:
+                # Measured at a fixed interval
+                env["RESTARTER_CHECK_MIN_SECONDS"] = str(self.scenario.check_every)
+                env["RESTARTER_CHECK_MAX_SECONDS"] = str(self.scenario.check_every)
+            log = open(os.path.join(tmp, "restarter.log"), "w")
+            process = subprocess.Popen(
+                [sys.executable, "-u", "main.py"],
+                cwd=ROOT,
+                env=env,
+                stdout=log,
+                stderr=subprocess.STDOUT,
+            )
+            try:
+                return self._measure(process)
+            except Exception:
+                if self.args.verbose:
+                    log.flush()
+                    sys.stderr.write(open(log.name).read())
+                raise
+            finally:
+                process.kill()
+                process.wait()
+                server.shutdown()
+                log.close()
+
+    def _measure(self, process):
+        before = self._wait_ready(process)
+        with self.daemon.lock:
+            calls = dict(self.daemon.calls)
+            delivered = self.daemon.delivered
+            starts = sum(map(len, self.daemon.starts.values()))
+
+        start = time.time()
+        trigger = threading.Thread(target=self.scenario.trigger, args=(self.daemon,))
+        trigger.start()
+        threads, rss = [], []
+        while not self._settled(process, trigger):
+            if time.time() - start > self.args.timeout:
+                raise RuntimeError(f"{self.scenario.name} didn't recover in time.")
+            if process.poll() is not None:
+                raise RuntimeError("restarter exited.")
+            t, r = _proc_status(process.pid)
+            threads.append(t)
+            rss.append(r)
+            time.sleep(SAMPLE_EVERY)
+        recovery = time.time() - start
+        after = scrape(self.port)
+
+        with self.daemon.lock:
+            calls = {
+                k: v - calls.get(k, 0)
+                for k, v in self.daemon.calls.items()
+                if v > calls.get(k, 0)
+            }
+            events = self.daemon.delivered - delivered
+            starts = sum(map(len, self.daemon.starts.values())) - starts
+
+        def mean_check(kind):
+            name = "restarter_check_duration_seconds"
+            labels = f'kind="{kind}"'
+            count = _total(after, f"{name}_count", labels) - _total(
+                before, f"{name}_count", labels
+            )
+            total = _total(after, f"{name}_sum", labels) - _total(
+                before, f"{name}_sum", labels
+            )
+            return round(total / count * 1000, 1) if count else None
+
+        api_calls = sum(calls.values())
+        return {
+            "scenario": self.scenario.name,
+            "engine": self.args.engine,
+            "events": events,
+            "api_calls": api_calls,
+            "api_calls_per_event": round(api_calls / events, 2) if events else None,
+            "starts": starts,
+            "adhoc_check_ms": mean_check("adhoc"),
+            "periodic_check_ms": mean_check("periodic"),
+            "max_threads": max(threads, default=None),
+            "max_rss_mb": round(max(rss), 1) if rss else None,
+            "recovery_s": round(recovery, 2),
+            "events_per_s": round(events / recovery) if events else None,
+            "calls": calls,
+        }
+
+
+COLUMNS = [
+    ("scenario", 16),
+    ("events", 7),
+    ("api_calls", 10),
+    ("api_calls_per_event", 20),
+    ("starts", 7),
+    ("adhoc_check_ms", 15),
+    ("periodic_check_ms", 18),
+    ("max_threads", 12),
+    ("max_rss_mb", 11),
+    ("recovery_s", 11),
+    ("events_per_s", 13),
+]
+
+
+def _format(value):
+    return "-" if value is None else str(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bench", description=__doc__)
+    parser.add_argument("scenarios", nargs="*", default=scenarios.DEFAULT)
+    parser.add_argument("--engine", default="threads", choices=["threads", "async"])
+    parser.add_argument(
+        "--latency-ms", type=float, default=1, help="latency of each API request"
+    )
+    parser.add_argument(
+        "--check-every", type=int, default=60, help="RESTARTER_CHECK_EVERY_SECONDS"
+    )
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--json", action="store_true", help="print JSON lines")
+    parser.add_argument(
+        "--verbose", action="store_true", help="print failed runs' logs"
+    )
+    args = parser.parse_args()
+
+    if not args.json:
+        print("".join(name.ljust(width) for name, width in COLUMNS))
+    failed = False
+    for spec in args.scenarios:
+        try:
+            result = Run(scenarios.get(spec), args)()
+        except (RuntimeError, ValueError) as err:
+            print(f"{spec}: {err}", file=sys.stderr)
+            failed = True
+            continue
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print("".join(_format(result[n]).ljust(w) for n, w in COLUMNS))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
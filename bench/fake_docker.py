@@ -0,0 +1,482 @@
+import json
+import os
+import re
+import socketserver
+import threading
+import time
+import urllib.parse
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler
+
+IMAGE_ID = "sha256:" + "0" * 64
+
+
+def _iso(ts):
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+def _human_duration(seconds):
+    """How the daemon humanizes durations in the `Status` of a listing."""
+    if seconds < 1:
+        return "Less than a second"
+    if seconds < 60:
+        return f"{int(seconds)} second{'s' if int(seconds) > 1 else ''}"
+    if (minutes := int(seconds / 60)) == 1:
+        return "About a minute"
+    if minutes < 60:
+        return f"{minutes} minutes"
+    if (hours := int(seconds / 3600 + 0.5)) == 1:
+        return "About an hour"
+    if hours < 48:
+        return f"{hours} hours"
+    return f"{hours // 24} days"
+
+
+def _host_config(network_mode):
+    """HostConfig with every field `docker_utils.get_container_run_args` reads."""
+    return {
+        "NetworkMode": network_mode,
+        "BlkioWeightDevice": None,
+        "BlkioWeight": 0,
+        "CapAdd": None,
+        "CapDrop": None,
+        "CgroupParent": "",
+        "CgroupnsMode": "private",
+        "CpuCount": 0,
+        "CpuPercent": 0,
+        "CpuPeriod": 0,
+        "CpuQuota": 0,
+        "CpuRealtimePeriod": 0,
+        "CpuRealtimeRuntime": 0,
+        "CpuShares": 0,
+        "CpusetCpus": "",
+        "CpusetMems": "",
+        "DeviceCgroupRules": None,
+        "BlkioDeviceReadBps": None,
+        "BlkioDeviceReadIOps": None,
+        "BlkioDeviceWriteBps": None,
+        "BlkioDeviceWriteIOps": None,
+        "Devices": None,
+        "DeviceRequests": None,
+        "Dns": None,
+        "DnsOptions": None,
+        "DnsSearch": None,
+        "GroupAdd": None,
+        "IpcMode": "private",
+        "Isolation": "",
+        "Memory": 0,
+        "MemoryReservation": 0,
+        "MemorySwappiness": None,
+        "MemorySwap": 0,
+        "NanoCpus": 0,
+        "OomKillDisable": None,
+        "OomScoreAdj": 0,
+        "PidMode": "",
+        "PidsLimit": None,
+        "Privileged": False,
+        "PublishAllPorts": False,
+        "ReadonlyRootfs": False,
+        "RestartPolicy": {"Name": "no", "MaximumRetryCount": 0},
+        "SecurityOpt": None,
+        "ShmSize": 67108864,
+        "UsernsMode": "",
+        "UTSMode": "",
+        "VolumeDriver": "",
+        "VolumesFrom": None,
+        "PortBindings": {},
+    }
+
+
+class Daemon:
+    """In-memory Docker Engine: containers, an event log and API call counters.
+
+    Containers with a healthcheck report `starting` when (re)started and turn
+    `healthy` after `health_delay` seconds, unless told otherwise.
+    """
+
+    def __init__(self, *, latency=0.0, health_delay=0.2):
+        self.latency = latency
+        self.health_delay = health_delay
+        self.lock = threading.Condition()
+        self.containers = {}
+        # (event, encoded event) pairs
+        self.events = []
+        self.calls = {}
+        # Events written to the `/events` streams, and how far each stream got
+        self.delivered = 0
+        self.cursors = {}
+        # name -> times the container was started, across recreations
+        self.starts = {}
+        # endpoint -> upcoming requests to answer with a server error
+        self.failures = {}
+
+    def add(
+        self,
+        name,
+        labels=None,
+        network_mode="bridge",
+        health=False,
+        status="running",
+        started_at=None,
+    ):
+        id = uuid.uuid4().hex + uuid.uuid4().hex
+        container = {
+            "Id": id,
+            "Name": "/" + name,
+            "Image": IMAGE_ID,
+            "Platform": "linux",
+            "Created": _iso(time.time()),
+            "Config": {
+                "Labels": labels or {},
+                "Image": "alpine",
+                "Cmd": ["sleep", "infinity"],
+                "Entrypoint": None,
+                "Env": [],
+                "WorkingDir": "",
+                "Domainname": "",
+                "Hostname": id[:12],
+                "OpenStdin": False,
+                "AttachStdout": False,
+                "AttachStderr": False,
+                "Tty": False,
+                "User": "",
+            },
+            "State": {
+                "Status": status,
+                "Running": status == "running",
+                "StartedAt": _iso(started_at or time.time()),
+            },
+            "HostConfig": _host_config(network_mode),
+            "NetworkSettings": {"MacAddress": ""},
+        }
+        if health:
+            container["Config"]["Healthcheck"] = {"Test": ["CMD", "true"]}
+            container["State"]["Health"] = {"Status": "healthy"}
+        with self.lock:
+            self.containers[id] = container
+        return id
+
+    def find(self, ref):
+        with self.lock:
+            if ref in self.containers:
+                return self.containers[ref]
+            for id, container in self.containers.items():
+                if container["Name"] == "/" + ref or id.startswith(ref):
+                    return container
+        return None
+
+    def emit(self, container, action, **extra):
+        self.publish(encode([self.event(container, action, **extra)]))
+
+    def event(self, container, action, **extra):
+        now = time.time_ns()
+        return {
+            "status": action,
+            "id": container["Id"],
+            "from": container["Config"]["Image"],
+            "Type": "container",
+            "Action": action,
+            "Actor": {
+                "ID": container["Id"],
+                "Attributes": {
+                    "name": container["Name"][1:],
+                    **container["Config"]["Labels"],
+                    **extra,
+                },
+            },
+            "scope": "local",
+            "time": now // 10**9,
+            "timeNano": now,
+        }
+
+    def publish(self, batch):
+        """Streams a batch of (event, encoded event) pairs, see `encode`."""
+        with self.lock:
+            self.events.extend(batch)
+            self.lock.notify_all()
+
+    def set_health(self, container, status):
+        container["State"]["Health"]["Status"] = status
+        self.emit(container, f"health_status: {status}")
+
+    def start(self, container):
+        name = container["Name"][1:]
+        with self.lock:
+            container["State"].update(
+                Status="running", Running=True, StartedAt=_iso(time.time())
+            )
+            self.starts.setdefault(name, []).append(time.time())
+        self.emit(container, "start")
+        if "Health" in container["State"]:
+            container["State"]["Health"]["Status"] = "starting"
+            threading.Timer(
+                self.health_delay,
+                self._healthy,
+                (container, container["State"]["StartedAt"]),
+            ).start()
+
+    def _healthy(self, container, started_at):
+        # Only if the container hasn't been restarted or told otherwise meanwhile
+        if (
+            container["State"]["StartedAt"] == started_at
+            and container["State"]["Health"]["Status"] == "starting"
+        ):
+            self.set_health(container, "healthy")
+
+    def stop(self, container, exit_code=0):
+        if not container["State"]["Running"]:
+            return
+        container["State"].update(Status="exited", Running=False, ExitCode=exit_code)
+        self.emit(container, "die")
+
+    def restart(self, container):
+        self.stop(container)
+        self.start(container)
+
+    def remove(self, container):
+        self.stop(container, 137)
+        with self.lock:
+            self.containers.pop(container["Id"], None)
+        self.emit(container, "destroy")
+
+    def recreate(self, container):
+        """Replaces a container with a new instance, e.g. after an image update."""
+        name = container["Name"][1:]
+        self.remove(container)
+        id = self.add(
+            name,
+            labels=container["Config"]["Labels"],
+            network_mode=container["HostConfig"]["NetworkMode"],
+            health="Health" in container["State"],
+            status="created",
+        )
+        self.emit(self.containers[id], "create")
+        self.start(self.containers[id])
+        return id
+
+    def create(self, name, body):
+        host_config = body.get("HostConfig", {})
+        id = self.add(
+            name or uuid.uuid4().hex[:8],
+            labels=body.get("Labels"),
+            network_mode=host_config.get("NetworkMode", "bridge"),
+            health="Healthcheck" in body,
+            status="created",
+        )
+        container = self.containers[id]
+        container["Config"].update(
+            {k: v for k, v in body.items() if k in container["Config"]}
+        )
+        self.emit(container, "create")
+        return id
+
+    def summary(self, container):
+        state = container["State"]
+        status = "Exited (0) 1 second ago"
+        if state["Running"]:
+            started_at = datetime.fromisoformat(state["StartedAt"]).timestamp()
+            status = f"Up {_human_duration(time.time() - started_at)}"
+            if "Health" in state:
+                status += f" ({state['Health']['Status']})"
+        return {
+            "Id": container["Id"],
+            "Names": [container["Name"]],
+            "Image": container["Config"]["Image"],
+            "ImageID": container["Image"],
+            "Labels": container["Config"]["Labels"],
+            "State": state["Status"],
+            "Status": status,
+            "HostConfig": {"NetworkMode": container["HostConfig"]["NetworkMode"]},
+        }
+
+    def drained(self):
+        """Whether every `/events` stream has been sent all the events so far."""
+        with self.lock:
+            return all(c == len(self.events) for c in self.cursors.values())
+
+
+def encode(events):
+    """Pairs events with their encoding, compact like the daemon's encoder."""
+    return [
+        (event, json.dumps(event, separators=(",", ":")).encode() + b"\n")
+        for event in events
+    ]
+
+
+def _matches(event, filters):
+    if (types := filters.get("type")) and event["Type"] not in types:
+        return False
+    if actions := filters.get("event"):
+        action = event["Action"]
+        return action in actions or action.split(":")[0] in actions
+    return True
+
+
+_OBJECT_ID = re.compile(r"/(containers|images)/(?!json$|create$)[^/]+")
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    daemon = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, code, obj=None):
+        body = json.dumps(obj).encode() if obj is not None else b""
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _route(self, method):
+        daemon = self.daemon
+        url = urllib.parse.urlparse(self.path)
+        path = re.sub(r"^/v[0-9.]+", "", url.path)
+        query = {k: v[-1] for k, v in urllib.parse.parse_qs(url.query).items()}
+        key = f"{method} {_OBJECT_ID.sub(lambda m: f'/{m.group(1)}/{{id}}', path)}"
+        with daemon.lock:
+            daemon.calls[key] = daemon.calls.get(key, 0) + 1
+            failing = daemon.failures.get(key, 0) > 0
+            if failing:
+                daemon.failures[key] -= 1
+        length = int(self.headers.get("Content-Length") or 0)
+        body = json.loads(self.rfile.read(length) or b"null") if length else None
+
+        if failing:
+            return self._send(500, {"message": "injected failure"})
+        if path == "/events":
+            return self._events(query)
+        if daemon.latency:
+            time.sleep(daemon.latency)
+
+        if path in ("/_ping", "/version"):
+            return self._send(200, {"ApiVersion": "1.45", "Version": "fake"})
+        if path == "/containers/json":
+            ids = json.loads(query.get("filters") or "{}").get("id", None)
+            with daemon.lock:
+                return self._send(
+                    200,
+                    [
+                        daemon.summary(c)
+                        for c in daemon.containers.values()
+                        if ids is None or c["Id"] in ids
+                    ],
+                )
+        if path == "/containers/create":
+            return self._send(
+                201, {"Id": daemon.create(query.get("name"), body), "Warnings": []}
+            )
+        if m := re.match(r"^/images/(.+)/json$", path):
+            return self._send(
+                200,
+                {
+                    "Id": IMAGE_ID,
+                    "RepoTags": ["alpine:latest"],
+                    "Config": {
+                        "Cmd": ["/bin/sh"],
+                        "Entrypoint": None,
+                        "Env": ["PATH=/usr/bin:/bin"],
+                        "Labels": None,
+                        "Volumes": None,
+                        "WorkingDir": "",
+                    },
+                },
+            )
+        if m := re.match(r"^/containers/([^/]+)(/[a-z]+)?$", path):
+            if (container := daemon.find(m.group(1))) is None:
+                return self._send(404, {"message": f"No such container: {m.group(1)}"})
+            action = (method, m.group(2))
+            if action == ("GET", "/json"):
+                with daemon.lock:
+                    return self._send(200, container)
+            if action == ("DELETE", None):
+                daemon.remove(container)
+            elif action == ("POST", "/start"):
+                daemon.start(container)
+            elif action == ("POST", "/stop"):
+                daemon.stop(container)
+            elif action == ("POST", "/restart"):
+                daemon.restart(container)
+            elif action == ("POST", "/rename"):
+                old_name = container["Name"]
+                container["Name"] = "/" + query["name"]
+                daemon.emit(container, "rename", oldName=old_name)
+            else:
+                return self._send(404, {"message": f"Not implemented: {method} {path}"})
+            return self._send(204)
+        return self._send(404, {"message": f"Not implemented: {method} {path}"})
+
+    def _events(self, query):
+        daemon = self.daemon
+        filters = json.loads(query.get("filters", "{}"))
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        with daemon.lock:
+            cursor = len(daemon.events)
+            if "since" in query:
+                since = float(query["since"]) * 10**9
+                cursor = next(
+                    (
+                        i
+                        for i, (e, _) in enumerate(daemon.events)
+                        if e["timeNano"] >= since
+                    ),
+                    cursor,
+                )
+            daemon.cursors[id(self)] = cursor
+        try:
+            while True:
+                with daemon.lock:
+                    while cursor >= len(daemon.events):
+                        daemon.lock.wait()
+                    batch = daemon.events[cursor:]
+                    cursor = len(daemon.events)
+                if batch := [line for e, line in batch if _matches(e, filters)]:
+                    # A chunk per event, like the daemon
+                    self.wfile.write(
+                        b"".join(
+                            f"{len(line):x}\r\n".encode() + line + b"\r\n"
+                            for line in batch
+                        )
+                    )
+                    self.wfile.flush()
+                with daemon.lock:
+                    daemon.delivered += len(batch)
+                    daemon.cursors[id(self)] = cursor
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            with daemon.lock:
+                daemon.cursors.pop(id(self), None)
+
+    def do_GET(self):
+        self._route("GET")
+
+    def do_POST(self):
+        self._route("POST")
+
+    def do_DELETE(self):
+        self._route("DELETE")
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    # Concurrent inspects of thousands of containers overflow the default of 5
+    request_queue_size = 128
+
+
+def serve(daemon, path):
+    """Serves `daemon` on Unix socket `path`, returns the server."""
+    if os.path.exists(path):
+        os.unlink(path)
+    handler = type("Handler", (Handler,), {"daemon": daemon})
+    server = _Server(path, handler)
+    threading.Thread(
+        name="fake-docker", target=server.serve_forever, daemon=True
+    ).start()
+    return server
@@ -0,0 +1,258 @@
+import time
+from datetime import datetime
+
+from bench import fake_docker
+from restarter.labels import (
+    COMPOSE_PROJECT,
+    COMPOSE_SERVICE,
+    RESTARTER_DEPENDS_ON,
+    RESTARTER_NETWORK_MODE,
+)
+
+
+def _started_at(container):
+    return datetime.fromisoformat(container["State"]["StartedAt"]).timestamp()
+
+
+class Scenario:
+    """A set of containers and a disturbance for restarter to recover from.
+
+    `edges` holds (child, parent, network) triples: once recovered every child has
+    been started after its parent and, if `network`, shares the parent's current
+    network namespace. `check_every` sets a fixed interval between the periodic
+    checks and `env` extra settings of restarter.
+    """
+
+    check_every = None
+    env = {}
+
+    def __init__(self, name, size):
+        self.name = f"{name}-{size}"
+        self.size = size
+        self.edges = []
+
+    def setup(self, daemon):
+        raise NotImplementedError
+
+    def trigger(self, daemon):
+        raise NotImplementedError
+
+    def converged(self, daemon):
+        with daemon.lock:
+            containers = {c["Name"][1:]: c for c in daemon.containers.values()}
+        for container in containers.values():
+            state = container["State"]
+            if not state["Running"] or state.get("Health", {}).get("Status") not in (
+                None,
+                "healthy",
+            ):
+                return False
+        for child, parent, network in self.edges:
+            if child not in containers or parent not in containers:
+                return False
+            if _started_at(containers[child]) <= _started_at(containers[parent]):
+                return False
+            network_mode = containers[child]["HostConfig"]["NetworkMode"]
+            if network and network_mode != f"container:{containers[parent]['Id']}":
+                return False
+        return True
+
+
+class Idle(Scenario):
+    """Independent containers and no disturbance: the cost of the periodic checks."""
+
+    DURATION = 3
+    check_every = 1
+
+    def setup(self, daemon):
+        for i in range(self.size):
+            daemon.add(f"app{i}", health=i % 2 == 0)
+
+    def trigger(self, daemon):
+        time.sleep(self.DURATION)
+
+
+class Projects(Idle):
+    """Compose projects of chained services and no disturbance: the cost of
+    evaluating the dependencies in the periodic checks."""
+
+    SERVICES = 10
+
+    def setup(self, daemon):
+        now = time.time()
+        for i in range(self.size):
+            project, service = divmod(i, self.SERVICES)
+            labels = {COMPOSE_PROJECT: f"p{project}", COMPOSE_SERVICE: f"s{service}"}
+            if service:
+                labels[RESTARTER_DEPENDS_ON] = f"service:s{service - 1}"
+            # Started after their dependencies, without waiting for it
+            daemon.add(
+                f"p{project}-s{service}",
+                labels=labels,
+                health=i % 2 == 0,
+                started_at=now - self.SERVICES + service,
+            )
+
+
+class Wide(Scenario):
+    """Children sharing the network of one parent, which gets restarted."""
+
+    def setup(self, daemon):
+        self.vpn = daemon.add("vpn", health=True)
+        time.sleep(0.01)
+        for i in range(self.size):
+            daemon.add(
+                f"client{i}",
+                labels={RESTARTER_NETWORK_MODE: "container:vpn"},
+                network_mode=f"container:{self.vpn}",
+            )
+            self.edges.append((f"client{i}", "vpn", True))
+
+    def trigger(self, daemon):
+        daemon.restart(daemon.containers[self.vpn])
+
+
+class Recreate(Wide):
+    """Children sharing the network of one parent, which gets replaced."""
+
+    def trigger(self, daemon):
+        daemon.recreate(daemon.containers[self.vpn])
+
+
+class Deep(Scenario):
+    """A chain of compose services, each depending on the previous one, whose root dies."""
+
+    def setup(self, daemon):
+        for i in range(self.size):
+            labels = {COMPOSE_PROJECT: "deep", COMPOSE_SERVICE: f"s{i}"}
+            if i:
+                labels[RESTARTER_DEPENDS_ON] = f"service:s{i - 1}"
+                self.edges.append((f"deep-s{i}", f"deep-s{i - 1}", False))
+            id = daemon.add(f"deep-s{i}", labels=labels, health=True)
+            if not i:
+                self.root = id
+            time.sleep(0.01)
+
+    def trigger(self, daemon):
+        daemon.stop(daemon.containers[self.root], 1)
+
+
+class Storm(Scenario):
+    """A burst of events which don't call for any action."""
+
+    ROUNDS = 20
+
+    def setup(self, daemon):
+        self.ids = [daemon.add(f"app{i}", health=True) for i in range(self.size)]
+
+    def trigger(self, daemon):
+        for _ in range(self.ROUNDS):
+            for id in self.ids:
+                container = daemon.containers[id]
+                daemon.emit(container, "exec_create: sh -c true")
+                daemon.emit(container, "exec_start: sh -c true")
+                daemon.emit(container, "exec_die")
+                daemon.set_health(container, "healthy")
+
+
+class Churn(Storm):
+    """A burst of events of containers with many labels, as on busy CI hosts."""
+
+    LABELS = 100
+
+    def setup(self, daemon):
+        labels = {f"com.example.ci.label{i}": "x" * 64 for i in range(self.LABELS)}
+        self.ids = [
+            daemon.add(f"app{i}", labels=labels, health=True) for i in range(self.size)
+        ]
+
+
+class Firehose(Churn):
+    """Tens of thousands of events of containers with many labels, emitted at once:
+    the throughput of reading and decoding the events. `update` events are
+    consumed without querying the daemon, unlike the events the store refreshes
+    containers upon."""
+
+    EVENTS = 50000
+    BATCH = 1000
+    # Queued rather than dropped in favour of a resync
+    env = {"RESTARTER_EVENT_QUEUE_SIZE": str(EVENTS)}
+
+    def setup(self, daemon):
+        super().setup(daemon)
+        # Encoded beforehand, not to measure the fake daemon's encoder
+        containers = [daemon.containers[id] for id in self.ids]
+        events = fake_docker.encode(
+            daemon.event(containers[i % len(containers)], "update")
+            for i in range(self.EVENTS)
+        )
+        self.batches = [
+            events[i : i + self.BATCH] for i in range(0, len(events), self.BATCH)
+        ]
+
+    def trigger(self, daemon):
+        for batch in self.batches:
+            daemon.publish(batch)
+
+
+class Flapping(Scenario):
+    """A parent whose healthcheck flaps for a while, with dependent children."""
+
+    FLIPS = 10
+    PERIOD = 0.3
+
+    def setup(self, daemon):
+        self.db = daemon.add("db", health=True)
+        time.sleep(0.01)
+        for i in range(self.size):
+            daemon.add(f"api{i}", labels={RESTARTER_DEPENDS_ON: "container:db"})
+            self.edges.append((f"api{i}", "db", False))
+
+    def trigger(self, daemon):
+        for i in range(self.FLIPS):
+            # The parent may have been replaced meanwhile, look it up by name
+            daemon.set_health(
+                daemon.find("db"), "unhealthy" if i % 2 == 0 else "healthy"
+            )
+            time.sleep(self.PERIOD)
+        daemon.set_health(daemon.find("db"), "healthy")
+
+
+SCENARIOS = {
+    "idle": Idle,
+    "projects": Projects,
+    "wide": Wide,
+    "recreate": Recreate,
+    "deep": Deep,
+    "storm": Storm,
+    "churn": Churn,
+    "firehose": Firehose,
+    "flapping": Flapping,
+}
+
+DEFAULT = [
+    "idle-10",
+    "idle-100",
+    "idle-1000",
+    "idle-10000",
+    "projects-10000",
+    "wide-10",
+    "wide-100",
+    "wide-1000",
+    "recreate-10",
+    "deep-8",
+    "storm-100",
+    "churn-100",
+    "firehose-100",
+    "flapping-20",
+]
+
+
+def get(spec):
+    """Instantiates a scenario from its `<name>-<size>` spec, e.g. `wide-100`."""
+    name, _, size = spec.rpartition("-")
+    if name not in SCENARIOS or not size.isdigit():
+        raise ValueError(
+            f"Unknown scenario {spec}, expected <name>-<size> with name in {', '.join(SCENARIOS)}."
+        )
+    return SCENARIOS[name](name, int(size))
@@ -1,4 +1,3 @@
-import math
 import queue
 import threading
 
@@ -11,31 +10,37 @@ errors = queue.Queue()
 threading.excepthook = excepthook
 
 
+import copy
 import functools
 import logging
 import queue
-import random
 import sys
 import threading
 import time
-from collections import defaultdict, deque
-from contextlib import contextmanager
 from datetime import datetime
 
 import docker
+import requests
 
+import restarter.actions as actions
 import restarter.config as config
 import restarter.docker_utils as docker_utils
+import restarter.evaluation as evaluation
+import restarter.events as events_
+import restarter.hosts as hosts
+import restarter.journal as journal_
+import restarter.limits as limits
+import restarter.metrics as metrics
+import restarter.planner as planner
+import restarter.scheduler as scheduler_
+import restarter.status as status_
+from restarter.labels import RESTARTER_NETWORK_MODE
 
 logging.basicConfig(format="[%(threadName)s] %(message)s", level=logging.INFO)
 
 
 # Keeps only the most recent element
 class CoalescingQueue(queue.Queue):
-    def __init__(self):
-        self._lock = RWLock()
-        super().__init__()
-
     def put(self, item):
         try:
             self.get(block=False)
@@ -44,220 +49,125 @@ class CoalescingQueue(queue.Queue):
         super().put(item)
 
 
-# Source: https://gist.github.com/tylerneylon/a7ff6017b7a1f9a506cf75aa23eacfd6
-class RWLock:
-    def __init__(self):
-        self.w_lock = threading.Lock()
-        self.num_r_lock = threading.Lock()
-        self.num_r = 0
-
-    def r_acquire(self):
-        self.num_r_lock.acquire()
-        self.num_r += 1
-        if self.num_r == 1:
-            self.w_lock.acquire()
-        self.num_r_lock.release()
-
-    def r_release(self):
-        self.num_r_lock.acquire()
-        self.num_r -= 1
-        if self.num_r == 0:
-            self.w_lock.release()
-        self.num_r_lock.release()
-
-    @contextmanager
-    def r_locked(self):
-        try:
-            self.r_acquire()
-            yield
-        finally:
-            self.r_release()
-
-    def w_acquire(self):
-        self.w_lock.acquire()
-
-    def w_release(self):
-        self.w_lock.release()
-
-    @contextmanager
-    def w_locked(self):
-        try:
-            self.w_acquire()
-            yield
-        finally:
-            self.w_release()
-
-
-class CannotRestartError(Exception):
-    pass
-
-
-class Worker:
-    def __init__(self, name):
-        self.name = name
+# Runs `func` on its own thread once a burst of triggers has settled
+# (no new trigger for `debounce_ms`) or `max_latency_ms` after the first one.
+# The items of all the triggers in a burst are passed to `func` as a set,
+# a trigger without item turns the set into None (i.e. "everything").
+class DebouncedCall:
+    def __init__(self, name, func, *, debounce_ms, max_latency_ms):
+        self.func = func
+        self.debounce = debounce_ms / 1000
+        self.max_latency = max_latency_ms / 1000
         self.lock = threading.Lock()
-        self.work = CoalescingQueue()
-        self.done = threading.Event()
-        self.recent_status = deque([None, None], maxlen=2)
-        threading.Thread(name=f"worker-{name}", target=self._work, daemon=True).start()
-        logging.info(f"Worker created for container {name}")
-
-    def _work(self):
+        self.items = set()
+        self.triggers = CoalescingQueue()
+        threading.Thread(name=name, target=self._run, daemon=True).start()
+
+    def trigger(self, item=None):
+        with self.lock:
+            if item is None or self.items is None:
+                self.items = None
+            else:
+                self.items.add(item)
+        self.triggers.put(time.time())
+
+    def _run(self):
         while True:
-            # Don't block on the work queue to allow GC to (reliably) assert whether
-            # (1) the work queue is empty (the read-write lock shared with the containers poller and the events handler)
-            # (2) and there is no work in progress (the lock below and the `done` Event)
-            while True:
-                time.sleep(1)
-                with self.lock:
-                    try:
-                        work_timestamp = self.work.get_nowait()
-                    except queue.Empty:
-                        continue
-                    else:
-                        self.done.clear()
-                break
-            if work_timestamp is None:
-                logging.info(f"Worker for container {self.name} is shutting down.")
-                self.done.set()
-                return
-
-            wait = max(math.ceil(work_timestamp + 10 - time.time()), 0)
-            if wait:
-                logging.info(f"Waiting {wait} seconds before taking any action.")
-                time.sleep(wait)
-
-            try:
+            first = last = self.triggers.get()
+            deadline = first + self.max_latency
+            while (timeout := min(last + self.debounce, deadline) - time.time()) > 0:
                 try:
-                    container = docker_utils.client.containers.get(self.name)
-                except docker.errors.NotFound:
-                    raise CannotRestartError(
-                        f"Container {self.name} doesn't exist anymore."
-                    )
-
-                settings = config.from_labels(container.labels)
-                started_at = datetime.fromisoformat(
-                    container.attrs["State"]["StartedAt"]
-                ).timestamp()
-                if started_at > work_timestamp:
-                    raise CannotRestartError(
-                        f"Container {self.name} has already been restarted."
-                    )
-
-                network_mode = container.attrs["HostConfig"].get("NetworkMode", "")
-                if not network_mode.startswith("container:"):
-                    try:
-                        logging.info(f"Restarting container {self.name}.")
-                        container.restart()
-                    except Exception as err:
-                        raise CannotRestartError(
-                            f"Failed to restart container {self.name}. Error: {err}"
-                        )
-                else:
-                    dependency_id = network_mode.split(":")[1]
-                    dependency = None
-                    try:
-                        dependency = docker_utils.client.containers.get(dependency_id)
-                    except docker.errors.NotFound:
-                        pass
-                    if dependency:
-                        logging.info(f"Restarting container {self.name}.")
-                        try:
-                            container.restart()
-                        except Exception as err:
-                            raise CannotRestartError(
-                                f"Failed to restart container {self.name}. Error: {err}"
-                            )
-                    else:
-                        parent = None
-                        restarter_network_mode = settings[config.Setting.NETWORK_MODE]
-                        if not restarter_network_mode:
-                            raise CannotRestartError(
-                                f"Label {RESTARTER_NETWORK_MODE} is required in order to recreate component {self.name}."
-                            )
-                        if restarter_network_mode.lower().startswith("container:"):
-                            dependency_name = restarter_network_mode.split(":")[1]
-                            try:
-                                parent = docker_utils.client.containers.get(
-                                    dependency_name
-                                )
-                            except docker.errors.NotFound:
-                                pass
-                        elif restarter_network_mode.lower().startswith("service:"):
-                            service = restarter_network_mode.split(":")[1]
-                            for p in docker_utils.list_with_retry():
-                                if p.labels.get(COMPOSE_SERVICE, "") == service:
-                                    parent = p
-                                    break
-                        elif container.labels.get(COMPOSE_SERVICE, ""):
-                            service = restarter_network_mode
-                            for p in docker_utils.list_with_retry():
-                                if p.labels.get(COMPOSE_SERVICE, "") == service:
-                                    parent = p
-                                    break
-                        else:
-                            dependency_name = restarter_network_mode
-                            try:
-                                parent = docker_utils.client.containers.get(
-                                    dependency_name
-                                )
-                            except docker.errors.NotFound:
-                                pass
-
-                        if not parent:
-                            raise CannotRestartError(
-                                f"Could not find any container matching {RESTARTER_NETWORK_MODE}={restarter_network_mode}."
-                            )
-
-                        run_args = docker_utils.get_container_run_args(
-                            container, parent.id
-                        )
-
-                        try:
-                            logging.info(f"Removing container {self.name}.")
-                            container.remove(force=True)
-                        except docker.errors.NotFound:
-                            raise CannotRestartError(
-                                f"Container {self.name} doesn't exist anymore."
-                            )
-
-                        logging.info(f"Recreating container {self.name}.")
-                        docker_utils.client.containers.run(**run_args)
-            except CannotRestartError as err:
-                logging.info(
-                    f"Can't/won't restart container {self.name}. Reason: {err}"
+                    last = self.triggers.get(timeout=timeout)
+                except queue.Empty:
+                    break
+            with self.lock:
+                items, self.items = self.items, set()
+            if items is None or items:
+                self.func(items)
+
+
+def current(ref, batch):
+    """Returns the container `ref` as it is now, None if it doesn't exist anymore.
+
+    The containers of a batch are looked up together, once per host.
+    """
+    host = ref.host
+    if batch is None:
+        try:
+            return host.client.containers.get(ref.name)
+        except docker.errors.NotFound:
+            return None
+    containers = batch.once(
+        ("current", host.name),
+        lambda: host.store.current(
+            [r.name for r in batch.names if r.host is host], batch.timestamp
+        ),
+    )
+    return containers.get(ref.name, None)
+
+
+def restart(ref, work_timestamp, batch=None):
+    host, name = ref.host, str(ref)
+    store = host.store
+    try:
+        container = current(ref, batch)
+        actions.check(name, container, work_timestamp)
+
+        if not actions.must_recreate(store, container):
+            try:
+                logging.info(f"Restarting container {name}.")
+                with metrics.action(name, "restart"):
+                    container.restart()
+            except Exception as err:
+                raise actions.CannotRestartError(
+                    f"Failed to restart container {name}. Error: {err}",
+                    "restart_failed",
                 )
-                continue
-            finally:
-                self.done.set()
-
-
-class Workers(dict[str, Worker], RWLock):
-    def __init__(self):
-        self._lock = RWLock()
-        dict.__init__(self)
-        RWLock.__init__(self)
-
-    def __getitem__(self, name):
-        if name not in self:
-            with self.w_locked():
-                if name not in self:
-                    self[name] = Worker(name)
-        return super().__getitem__(name)
+            actions.restarted(host, container.id)
+            return "restarted"
 
+        settings = config.from_labels(container.labels)
+        target = settings.network_target
+        if not target:
+            raise actions.CannotRestartError(
+                f"Label {RESTARTER_NETWORK_MODE} is required in order to recreate component {name}.",
+                "missing_network_mode",
+            )
+        parent = store.resolve(container, target)
+        if not parent:
+            raise actions.CannotRestartError(
+                f"Could not find any container matching {RESTARTER_NETWORK_MODE}={settings[config.Setting.NETWORK_MODE]}.",
+                "parent_not_found",
+            )
 
-# CONSTANTS
-RESTARTER_DEPENDS_ON = "restarter.depends_on"
-RESTARTER_NETWORK_MODE = "restarter.network_mode"
-COMPOSE_CONFIG_FILES = "com.docker.compose.project.config_files"
-COMPOSE_DEPENDS_ON = "com.docker.compose.depends_on"
-COMPOSE_PROJECT = "com.docker.compose.project"
-COMPOSE_SERVICE = "com.docker.compose.service"
-COMPOSE_WORKING_DIR = "com.docker.compose.project.working_dir"
+        run_args = {
+            **host.run_args.get(container),
+            "network_mode": f"container:{parent.id}",
+        }
 
-# globals
-workers_lock = RWLock()
-workers = Workers()
+        with metrics.action(name, "recreate"):
+            logging.info(f"Recreating container {name}.")
+            try:
+                recreated, timings = docker_utils.recreate(
+                    host.client, container, run_args
+                )
+            except docker.errors.NotFound:
+                raise actions.CannotRestartError(
+                    f"Container {name} doesn't exist anymore.", "not_found"
+                )
+            except docker.errors.APIError as err:
+                raise actions.CannotRestartError(
+                    f"Failed to recreate container {name}. Error: {err}",
+                    "recreate_failed",
+                )
+        logging.info(
+            f"Recreated container {name} ({', '.join(f'{phase} {round(duration, 3)}s' for phase, duration in timings.items())})."
+        )
+        actions.restarted(host, recreated.id)
+        return "recreated"
+    except actions.CannotRestartError as err:
+        actions.cannot_restart(name, err)
+        return err.reason
 
 
 def timed(*, message):
@@ -276,145 +186,178 @@ def timed(*, message):
     return decorator
 
 
-def repeat(*, every_seconds):
+# Calls `func` until it returns, again after a backoff whenever it fails: the
+# unexpected errors of a host's `thread` stay with that host
+def supervised(host, thread):
     def decorator(func):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
+            attempt = 0
             while True:
-                func(*args, **kwargs)
-                time.sleep(every_seconds)
+                try:
+                    return func(*args, **kwargs)
+                except Exception as err:
+                    delay = docker_utils.backoff(attempt)
+                    attempt += 1
+                    metrics.HOST_FAILURES.inc(host=host.name, thread=thread)
+                    logging.info(
+                        f"Unexpected error on host {host}. Retrying in {round(delay, 1)} seconds. Error: {err!r}"
+                    )
+                    time.sleep(delay)
 
         return wrapper
 
     return decorator
 
 
-def check_containers():
-    containers = docker_utils.list_with_retry(all=True)
+# Calls `func`, which returns whether it corrected a drift, at a `polling.Interval`
+def repeat(interval, *, wait_first=False):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if wait_first:
+                interval.wait()
+            while True:
+                interval.checked(func(*args, **kwargs))
+                interval.wait()
 
-    containers_idx = defaultdict(dict)
-    for container in containers:
-        containers_idx["id"][container.id] = container
-        containers_idx["name"][container.name] = container
-        if service := container.labels.get(COMPOSE_SERVICE, None):
-            containers_idx["service"][service] = container
+        return wrapper
 
+    return decorator
+
+
+# Without `ids` all containers are evaluated, otherwise only the given containers
+# and the ones that (transitively) depend on them.
+def containers_to_restart(store, ids=None):
     to_be_restarted = set()
-    for container in containers:
-        settings = config.from_labels(container.labels)
-        if not settings[config.Setting.ENABLE]:
-            continue
+    for kind, name, dependency in evaluation.evaluate(store.snapshot(ids)):
+        if kind == evaluation.UNHEALTHY:
+            logging.info(f"Container {name} is in unhealthy state.")
+            to_be_restarted.add(name)
+        elif kind == evaluation.DEPENDENCY_DOWN:
+            logging.info(
+                f"Container {dependency} is in unhealthy state or not running and container {name} depends on it."
+            )
+            to_be_restarted.add(dependency)
+            to_be_restarted.add(name)
+        elif kind == evaluation.STARTED_BEFORE:
+            logging.info(
+                f"Container {name} has been started before its dependency {dependency}."
+            )
+            to_be_restarted.add(name)
 
-        if (
-            config.Policy.UNHEALTHY in settings[config.Setting.POLICY]
-            and container.attrs["State"].get("Health", {}).get("Status", "")
-            == "unhealthy"
-        ):
-            logging.info(f"Container {container.name} is in unhealthy state.")
-            to_be_restarted.add(container.name)
-
-        if config.Policy.DEPENDENCY in settings[config.Setting.POLICY]:
-            dependencies = set()
-
-            if (
-                network_mode := container.attrs["HostConfig"].get("NetworkMode", "")
-            ).startswith("container:"):
-                dependency_id = network_mode.split(":")[1]
-                if dependency_id in containers_idx["id"]:
-                    dependencies.add(containers_idx["id"][dependency_id])
-
-            for depends_on in container.labels.get(COMPOSE_DEPENDS_ON, "").split(","):
-                if not depends_on:
-                    continue
-                service = depends_on.split(":")[0]
-                if service in containers_idx["service"]:
-                    dependencies.add(containers_idx["service"][service])
-
-            for depends_on in container.labels.get(RESTARTER_DEPENDS_ON, "").split(
-                ","
-            ) + [container.labels.get(RESTARTER_NETWORK_MODE, "")]:
-                if not depends_on:
-                    continue
-                if depends_on.startswith("container:"):
-                    dependency_name = depends_on.split(":")[1]
-                    if dependency_name in containers_idx["name"]:
-                        dependencies.add(containers_idx["name"][dependency_name])
-                elif depends_on.startswith("service:"):
-                    service = depends_on.split(":")[1]
-                    if service in containers_idx["service"]:
-                        dependencies.add(containers_idx["service"][service])
-                elif container.labels.get(COMPOSE_SERVICE, ""):
-                    if depends_on in containers_idx["service"]:
-                        dependencies.add(containers_idx["service"][depends_on])
-                else:
-                    if depends_on in containers_idx["name"]:
-                        dependencies.add(containers_idx["name"][depends_on])
-
-            started_at = datetime.fromisoformat(
-                container.attrs["State"]["StartedAt"]
-            ).timestamp()
-            for dependency in dependencies:
-                if (
-                    dependency.attrs["State"].get("Health", {}).get("Status", "")
-                    == "unhealthy"
-                    or dependency.attrs["State"]["Status"] != "running"
-                ):
-                    logging.info(
-                        f"Container {dependency.name} is in unhealthy state or not running and container {container.name} depends on it."
-                    )
-                    to_be_restarted.add(dependency.name)
-                    to_be_restarted.add(container.name)
+    return to_be_restarted
 
-                dependency_started_at = datetime.fromisoformat(
-                    dependency.attrs["State"]["StartedAt"]
-                ).timestamp()
-                if started_at <= dependency_started_at:
-                    logging.info(
-                        f"Container {container.name} has been started before its dependency {dependency.name}."
-                    )
-                    to_be_restarted.add(container.name)
 
+def check_containers(host, ids=None):
     timestamp = time.time()
-    for container_name in to_be_restarted:
-        with workers_lock.r_locked():
-            workers[container_name].work.put(timestamp)
-
-
-@repeat(
-    every_seconds=config.global_settings[config.GlobalSetting.GC_EVERY_SECONDS],
-)
-@timed(message="Periodic garbage collection")
-def gc():
-    with workers_lock.w_locked():
-        for name in list(workers.keys()):
-            with workers[name].lock:
-                if workers[name].work.empty() and workers[name].done.is_set():
-                    logging.info(
-                        f"Worker for container {name} is not required anymore."
-                    )
-                    workers[name].work.put(None)
-                    del workers[name]
+    plan = planner.waves(host.store, containers_to_restart(host.store, ids))
+    planner.log(plan)
+    if ids is None:
+        status_.board.evaluated(host.name, host.store.snapshot())
+    status_.board.planned(host.name, timestamp, plan)
+    scheduler.submit_plan(
+        [[hosts.Ref(host, name) for name in wave] for wave in plan], timestamp
+    )
+
+
+def resync_and_check(host):
+    drift = host.store.resync()
+    host.run_args.prepare(host.store.containers())
+    check_containers(host)
+    return drift
+
+
+# Finds out with a full resync what the events didn't tell
+def resync_after_events(host, adhoc_check, reason):
+    host.interval.tighten(reason)
+    try:
+        host.store.resync()
+    except (docker.errors.APIError, requests.exceptions.RequestException) as err:
+        logging.info(
+            f"Failed to resync host {host}, leaving it to the periodic check. Error: {err}"
+        )
+        return
+    scheduler.poke()
+    adhoc_check.trigger()
+
+
+def forget(ref):
+    scheduler.forget(ref)
+    limits.limiter.forget(str(ref))
+
+
+def events(host, adhoc_check, subscription):
+    for event in subscription:
+        if event is events_.OVERFLOW:
+            resync_after_events(host, adhoc_check, "overflow")
+            continue
+        metrics.observe_event(host.name, event)
+        if journal is not None and "timeNano" in event:
+            journal.cursor(host.name, event["timeNano"])
+        if (gone := actions.invalidate(host, event)) is not None:
+            forget(hosts.Ref(host, gone))
+        if event.get("Type") == "image":
+            continue
+        try:
+            if host.store.update(event):
+                scheduler.poke()
+        except (docker.errors.APIError, requests.exceptions.RequestException) as err:
+            logging.info(
+                f"Failed to refresh container {event['id']} of host {host}. Resyncing instead. Error: {err}"
+            )
+            resync_after_events(host, adhoc_check, "refresh_failed")
+        status = event["status"]
+        attributes = event["Actor"]["Attributes"]
+        if status not in actions.MONITORED_EVENTS:
+            continue
+        ref = hosts.Ref(host, attributes["name"])
+        scheduler.observe(ref, status)
 
+        logging.info(
+            f'Received a "{status}" event for container {ref}. Scheduling a check of the container and its dependents.'
+        )
+        adhoc_check.trigger(event["id"])
 
-MONITORED_EVENTS = ("start", "health_status: unhealthy", "die")
 
+def _ref(host_name, name):
+    by_name = {host.name: host for host in hosts_}
+    return hosts.Ref(by_name[host_name], name) if host_name in by_name else None
 
-def events():
-    for event in docker_utils.client.events(
-        decode=True,
-        filters={"type": "container"},
-    ):
-        status = event["status"]
-        if status not in MONITORED_EVENTS:
-            continue
-        with workers_lock.r_locked():
-            name = event["Actor"]["Attributes"]["name"]
-            workers[name].recent_status.append(status)
 
-            logging.info(
-                f'Received a "{status}" event for container {name}. Triggering a full check.'
-            )
-            timed(message="Ad-hoc containers check")(check_containers)()
+# Restores the limiter's history recorded by the journal
+def restore_history(saved):
+    for key, history in saved.history.items():
+        if r := _ref(*key):
+            limits.limiter.restore(str(r), history)
+
+
+# Resumes the pending requests of `host` recorded by the journal, once its store
+# is seeded: the scheduler gates them on it
+def restore_pending(saved, host):
+    for key, timestamps in saved.pending.items():
+        if key[0] != host.name:
+            continue
+        r = _ref(*key)
+        # The earliest request wins anyway, see `Scheduler._submit`
+        timestamp = min(timestamps)
+        after = [a for a in (_ref(*a) for a in timestamps[timestamp]) if a]
+        logging.info(f"Resuming the pending restart of container {r}.")
+        scheduler.submit(r, timestamp, after)
+
+
+# Returns the `timeNano` to resume the events of `host` from, if the journal's
+# cursor is recent enough for the missed events to replace a full check
+def resume_from(saved, host):
+    if saved is None or (time_nano := saved.cursors.get(host.name)) is None:
+        return None
+    every_seconds = config.global_settings[config.GlobalSetting.CHECK_EVERY_SECONDS]
+    if time.time() - time_nano / 1e9 >= every_seconds:
+        return None
+    logging.info(
+        f"Resuming the events of host {host} from {datetime.fromtimestamp(time_nano / 1e9)}."
+    )
+    return time_nano
 
 
 logging.info("docker-restarter https://github.com/cascandaliato/docker-restarter")
@@ -422,15 +365,132 @@ config.dump_env_variables()
 config.dump(config.global_settings, "Global settings:")
 config.dump(config.defaults, "Defaults:")
 
-threading.Thread(name="events", target=events, daemon=True).start()
-threading.Thread(
-    name="poller",
-    target=repeat(
-        every_seconds=config.global_settings[config.GlobalSetting.CHECK_EVERY_SECONDS]
-    )(timed(message="Periodic containers check")(check_containers)),
-).start()
-time.sleep(random.randrange(10))
-threading.Thread(name="gc", target=gc, daemon=True).start()
+evaluation.start()
+
+if port := config.global_settings[config.GlobalSetting.METRICS_PORT]:
+    metrics.serve(port)
+if port := config.global_settings[config.GlobalSetting.STATUS_PORT]:
+    status_.board.limiter = limits.limiter
+    status_.serve(port)
+
+hosts_ = hosts.from_config()
+
+journal = None
+if path := config.global_settings[config.GlobalSetting.JOURNAL]:
+    journal = journal_.Journal(path, retention=limits.limiter.longest_window)
+
+if config.global_settings[config.GlobalSetting.ENGINE] == "async":
+    import restarter.aio as aio
+
+    if len(hosts_) > 1:
+        raise ValueError("The async engine supports a single host.")
+    if journal is not None:
+        logging.info(
+            "The journal is only supported by the threads engine, ignoring it."
+        )
+        journal = None
+    host = hosts_[0]
+    threading.Thread(
+        name="engine",
+        target=aio.run,
+        args=(
+            host,
+            containers_to_restart,
+            lambda name, timestamp: restart(hosts.Ref(host, name), timestamp),
+        ),
+        daemon=True,
+    ).start()
+else:
+    # Copied while nothing runs yet: the journal's state changes with what the
+    # scheduler and the events streams record
+    saved = copy.deepcopy(journal.state()) if journal is not None else None
+    scheduler = scheduler_.Scheduler(
+        restart,
+        executor=lambda ref: ref.host.executor,
+        gate=lambda ref, timestamp: limits.limiter.gate(
+            ref.host.store,
+            ref.name,
+            timestamp,
+            key=str(ref),
+            # Only the restarts the limiter counts, to restore them as such
+            restarted=(
+                functools.partial(journal.restarted, ref)
+                if journal is not None
+                else None
+            ),
+        ),
+        journal=journal,
+    )
+    metrics.QUEUE_DEPTH.set_function(scheduler.depth)
+    status_.board.scheduler = scheduler
+    if saved is not None:
+        restore_history(saved)
+
+    # Each host on its own, an unreachable one doesn't hold up the others
+    def start(host):
+        message = "Initial containers listing"
+        if host.qualified:
+            message += f" of host {host}"
+
+        @supervised(host, "startup")
+        def seed():
+            docker_utils.negotiate(host.client, host)
+            timed(message=message)(host.store.resync)()
+
+        seed()
+        if saved is not None:
+            restore_pending(saved, host)
+        time_nano = resume_from(saved, host)
+        adhoc_check = DebouncedCall(
+            host.thread_name("evaluator"),
+            supervised(host, "evaluator")(
+                timed(message="Ad-hoc containers check")(
+                    metrics.CHECK_DURATION.time(host=host.name, kind="adhoc")(
+                        status_.board.time(host.name, "adhoc")(
+                            functools.partial(check_containers, host)
+                        )
+                    )
+                )
+            ),
+            debounce_ms=config.global_settings[config.GlobalSetting.EVENT_DEBOUNCE_MS],
+            max_latency_ms=config.global_settings[
+                config.GlobalSetting.EVENT_MAX_LATENCY_MS
+            ],
+        )
+        subscription = events_.Subscription(
+            host,
+            size=config.global_settings[config.GlobalSetting.EVENT_QUEUE_SIZE],
+            time_nano=time_nano,
+        )
+        threading.Thread(
+            name=host.thread_name("events"),
+            target=supervised(host, "events")(events),
+            args=(host, adhoc_check, subscription),
+            daemon=True,
+        ).start()
+        threading.Thread(
+            name=host.thread_name("poller"),
+            target=repeat(
+                host.interval,
+                # The events missed meanwhile are replayed instead
+                wait_first=time_nano is not None,
+            )(
+                supervised(host, "poller")(
+                    timed(message="Periodic containers check")(
+                        metrics.CHECK_DURATION.time(host=host.name, kind="periodic")(
+                            status_.board.time(host.name, "periodic")(
+                                functools.partial(resync_and_check, host)
+                            )
+                        )
+                    )
+                )
+            ),
+        ).start()
+
+    for host in hosts_:
+        threading.Thread(
+            name=host.thread_name("startup"), target=start, args=(host,)
+        ).start()
 
 error = errors.get()
 
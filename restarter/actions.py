@@ -0,0 +1,74 @@
+import logging
+from datetime import datetime
+
+import restarter.metrics as metrics
+
+# Events upon which a container and its dependents are checked
+MONITORED_EVENTS = ("start", "health_status: unhealthy", "die")
+
+
+class CannotRestartError(Exception):
+    def __init__(self, message, reason):
+        super().__init__(message)
+        self.reason = reason
+
+
+def invalidate(host, event):
+    """Drops what `event` makes stale from the caches of `host`.
+
+    Returns the name a container doesn't go by anymore, destroyed or renamed, if
+    any: what is kept about it by name is to be forgotten.
+    """
+    if event.get("Type") == "image":
+        if event["status"] == "delete":
+            host.images.invalidate(event["id"])
+        return None
+    status = event["status"]
+    attributes = event["Actor"]["Attributes"]
+    if status in ("destroy", "rename", "update"):
+        host.run_args.invalidate(event["id"])
+    if status == "destroy":
+        return attributes["name"]
+    if status == "rename":
+        return attributes["oldName"].lstrip("/")
+    return None
+
+
+def check(name, container, timestamp):
+    """Raises CannotRestartError unless `container`, None if it doesn't exist
+    anymore, is still to be acted upon for a request made at `timestamp`."""
+    if container is None:
+        raise CannotRestartError(
+            f"Container {name} doesn't exist anymore.", "not_found"
+        )
+    started_at = datetime.fromisoformat(
+        container.attrs["State"]["StartedAt"]
+    ).timestamp()
+    if started_at > timestamp:
+        raise CannotRestartError(
+            f"Container {name} has already been restarted.", "already_restarted"
+        )
+
+
+def must_recreate(store, container):
+    """Whether `container` shares the network namespace of a container which doesn't
+    exist anymore, in which case it can't be restarted but only recreated."""
+    network_mode = container.attrs["HostConfig"].get("NetworkMode", "")
+    return (
+        network_mode.startswith("container:")
+        and store.get(network_mode.split(":")[1]) is None
+    )
+
+
+def restarted(host, id):
+    """Follows up on the restart, or recreation, of container `id` of `host`."""
+    # Dependents are gated on this container's state and the checks see it through
+    # the store, don't wait for the events
+    host.store.refresh(id)
+    # Keep a closer watch on the host for a while
+    host.interval.tighten("restart")
+
+
+def cannot_restart(name, err):
+    metrics.CANNOT_RESTART.inc(reason=err.reason)
+    logging.info(f"Can't/won't restart container {name}. Reason: {err}")
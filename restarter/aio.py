@@ -0,0 +1,374 @@
+import asyncio
+import json
+import logging
+import os
+import time
+import urllib.parse
+
+import restarter.actions as actions
+import restarter.config as config
+import restarter.docker_utils as docker_utils
+import restarter.events as events_
+import restarter.limits as limits
+import restarter.metrics as metrics
+import restarter.planner as planner
+import restarter.state as state
+import restarter.status as status_
+
+DEFAULT_SOCKET = "/var/run/docker.sock"
+POOL_SIZE = 8
+
+
+class APIError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+
+
+def socket_path(url=None):
+    host = url or os.environ.get("DOCKER_HOST", f"unix://{DEFAULT_SOCKET}")
+    if not host.startswith("unix://"):
+        raise ValueError(f"The async engine only supports Unix sockets, got {host}.")
+    return host[len("unix://") :]
+
+
+async def _read_body(reader, headers):
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        body = bytearray()
+        while chunk := await _read_chunk(reader):
+            body += chunk
+        return bytes(body)
+    return await reader.readexactly(int(headers.get("content-length", 0)))
+
+
+async def _read_chunk(reader):
+    size = int((await reader.readline()).split(b";")[0], 16)
+    chunk = await reader.readexactly(size) if size else b""
+    await reader.readline()
+    return chunk
+
+
+async def _read_head(reader):
+    status = int((await reader.readline()).split()[1])
+    headers = {}
+    while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+        key, value = line.decode("latin-1").split(":", 1)
+        headers[key.strip().lower()] = value.strip()
+    return status, headers
+
+
+class UnixHTTPClient:
+    """Minimal HTTP/1.1 client for the Docker Engine API.
+
+    Requests share a small pool of keep-alive connections, streams (e.g. `/events`)
+    get a dedicated connection each.
+    """
+
+    def __init__(self, path, version, host, pool_size=POOL_SIZE):
+        self._path = path
+        self._host = host
+        self._prefix = f"/v{version}"
+        self._idle = []
+        self._slots = asyncio.Semaphore(pool_size)
+
+    def _request_line(self, method, path, params, body):
+        url = self._prefix + path
+        if params:
+            url += "?" + urllib.parse.urlencode(params)
+        head = f"{method} {url} HTTP/1.1\r\nHost: docker\r\n"
+        if body is not None:
+            head += "Content-Type: application/json\r\n"
+        head += f"Content-Length: {len(body or b'')}\r\n\r\n"
+        return head.encode() + (body or b"")
+
+    async def request(self, method, path, params=None, payload=None):
+        body = json.dumps(payload).encode() if payload is not None else None
+        with metrics.api_call(self._host, method, path):
+            status, data = await self._request(method, path, params, body)
+
+        if status >= 400:
+            try:
+                message = json.loads(data)["message"]
+            except (ValueError, KeyError):
+                message = data.decode(errors="replace")
+            raise APIError(status, message)
+        return json.loads(data) if data else None
+
+    async def _request(self, method, path, params, body):
+        async with self._slots:
+            for attempt in range(2):
+                reused = bool(self._idle)
+                reader, writer = (
+                    self._idle.pop()
+                    if reused
+                    else await asyncio.open_unix_connection(self._path)
+                )
+                try:
+                    writer.write(self._request_line(method, path, params, body))
+                    await writer.drain()
+                    status, headers = await _read_head(reader)
+                    data = await _read_body(reader, headers)
+                except (ConnectionError, asyncio.IncompleteReadError, IndexError):
+                    writer.close()
+                    # The daemon may have closed an idle connection, retry on a new one
+                    if reused and attempt == 0:
+                        continue
+                    raise
+                if headers.get("connection", "").lower() == "close":
+                    writer.close()
+                else:
+                    self._idle.append((reader, writer))
+                return status, data
+
+    async def stream(self, path, params=None):
+        reader, writer = await asyncio.open_unix_connection(self._path)
+        try:
+            with metrics.api_call(self._host, "GET", path):
+                writer.write(self._request_line("GET", path, params, None))
+                await writer.drain()
+                status, headers = await _read_head(reader)
+            if status >= 400:
+                raise APIError(status, (await _read_body(reader, headers)).decode())
+            decoder = events_.Decoder()
+            while chunk := await _read_chunk(reader):
+                for event in decoder.feed(chunk):
+                    yield event
+        finally:
+            writer.close()
+
+
+class Engine:
+    """Event loop based counterpart of the thread based daemon in `main.py`.
+
+    It shares the container store and the evaluation logic with the thread based
+    daemon: `evaluate(store, ids)` returns the names of the containers to restart
+    and `recreate(name, timestamp)` is the (blocking) restart flow, only used, in a
+    worker thread, when a container has to be recreated. It supervises a single
+    `hosts.Host`, which has to be reachable through a Unix socket.
+    """
+
+    def __init__(self, host, evaluate, recreate):
+        self.host = host
+        self.store = host.store
+        self.evaluate = evaluate
+        self.recreate = recreate
+        self.pending = {}
+        self.tasks = {}
+        self.after = {}
+        self.triggered = set()
+
+    async def run(self):
+        self.http = UnixHTTPClient(
+            socket_path(self.host.url), self.host.client.api.api_version, self.host.name
+        )
+        self.restarts = asyncio.Semaphore(
+            config.global_settings[config.GlobalSetting.MAX_CONCURRENT_RESTARTS]
+        )
+        self.trigger = asyncio.Event()
+        self.changed = asyncio.Condition()
+        metrics.QUEUE_DEPTH.set_function(lambda: len(self.pending))
+        await asyncio.gather(self.events(), self.poller(), self.evaluator())
+
+    async def inspect(self, id):
+        try:
+            attrs = await self.http.request("GET", f"/containers/{id}/json")
+        except APIError as err:
+            if err.status == 404:
+                return None
+            raise
+        return self.host.client.containers.prepare_model(attrs)
+
+    async def resync(self):
+        """`state.Store.resync` over the async client, retrying as `list_with_retry`
+        does on server and connection errors."""
+        attempt = 0
+        while True:
+            try:
+                summaries = await self.http.request(
+                    "GET", "/containers/json", {"all": 1}
+                )
+                fresh, stale, since = self.store.diff(summaries)
+                inspected = await asyncio.gather(*(self.inspect(id) for id in stale))
+                break
+            except (OSError, APIError, asyncio.IncompleteReadError) as err:
+                if isinstance(err, APIError) and err.status < 500:
+                    raise
+                delay = docker_utils.backoff(attempt)
+                attempt += 1
+                logging.info(
+                    f"Failed to retrieve containers. Retrying in {round(delay, 1)} seconds. Error: {err}"
+                )
+                await asyncio.sleep(delay)
+        return self.store.replace(
+            fresh + [c for c in inspected if c is not None], since
+        )
+
+    async def poller(self):
+        while True:
+            start = time.time()
+            logging.info("Periodic containers check... Starting")
+            drift = await self.resync()
+            await asyncio.to_thread(self.host.run_args.prepare, self.store.containers())
+            self.dispatch(self.evaluate(self.store, None))
+            status_.board.evaluated(self.host.name, self.store.snapshot())
+            duration = time.time() - start
+            metrics.CHECK_DURATION.observe(
+                duration, host=self.host.name, kind="periodic"
+            )
+            status_.board.checked(self.host.name, "periodic", start, duration)
+            logging.info(f"Periodic containers check... Done ({round(duration, 1)}s)")
+            self.host.interval.checked(drift)
+            await asyncio.to_thread(self.host.interval.wait)
+
+    async def events(self):
+        filters = json.dumps(events_.FILTERS)
+        last, attempt = None, 0
+        while True:
+            params = {"filters": filters}
+            if last is not None:
+                params["since"] = events_.since(last)
+            try:
+                async for event in self.http.stream("/events", params):
+                    attempt = 0
+                    last = event.get("timeNano", last)
+                    await self.handle(event)
+                error = "the stream ended"
+            except (OSError, APIError, asyncio.IncompleteReadError) as err:
+                error = err
+            delay = docker_utils.backoff(attempt)
+            attempt += 1
+            metrics.EVENT_RECONNECTS.inc(host=self.host.name)
+            self.host.interval.tighten("reconnect")
+            logging.info(
+                f"Lost the events of host {self.host}. Reconnecting in {round(delay, 1)} seconds. Error: {error}"
+            )
+            await asyncio.sleep(delay)
+
+    async def handle(self, event):
+        metrics.observe_event(self.host.name, event)
+        if (gone := actions.invalidate(self.host, event)) is not None:
+            limits.limiter.forget(gone)
+        if event.get("Type") == "image":
+            return
+        status = event["status"]
+        if status.split(":")[0] in state.STORE_EVENTS:
+            if status == "destroy":
+                self.store.remove(event["id"])
+            elif (container := await self.inspect(event["id"])) is None:
+                self.store.remove(event["id"])
+            else:
+                self.store.put(container)
+            await self.notify()
+        if status not in actions.MONITORED_EVENTS:
+            return
+        name = event["Actor"]["Attributes"]["name"]
+        logging.info(
+            f'Received a "{status}" event for container {name}. Scheduling a check of the container and its dependents.'
+        )
+        self.triggered.add(event["id"])
+        self.trigger.set()
+
+    async def evaluator(self):
+        debounce = config.global_settings[config.GlobalSetting.EVENT_DEBOUNCE_MS] / 1000
+        max_latency = (
+            config.global_settings[config.GlobalSetting.EVENT_MAX_LATENCY_MS] / 1000
+        )
+        while True:
+            await self.trigger.wait()
+            deadline = time.time() + max_latency
+            while (timeout := min(debounce, deadline - time.time())) > 0:
+                self.trigger.clear()
+                try:
+                    await asyncio.wait_for(self.trigger.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            self.trigger.clear()
+            ids, self.triggered = self.triggered, set()
+            start = time.time()
+            self.dispatch(self.evaluate(self.store, ids))
+            duration = time.time() - start
+            metrics.CHECK_DURATION.observe(duration, host=self.host.name, kind="adhoc")
+            status_.board.checked(self.host.name, "adhoc", start, duration)
+
+    def dispatch(self, names):
+        timestamp = time.time()
+        plan = planner.waves(self.store, names)
+        planner.log(plan)
+        status_.board.planned(self.host.name, timestamp, plan)
+        for previous, wave in zip([()] + plan, plan):
+            for name in wave:
+                self.submit(name, timestamp, after=previous)
+
+    def submit(self, name, timestamp, after=()):
+        if name in self.pending:
+            return
+        self.pending[name] = timestamp
+        self.after[name] = tuple(after)
+        if name not in self.tasks:
+            logging.info(f"Action on container {name} scheduled.")
+            self.tasks[name] = asyncio.create_task(self.act(name))
+
+    async def act(self, name):
+        try:
+            while name in self.pending:
+                timestamp = self.pending[name]
+                async with self.changed:
+                    # Wait for the previous wave of the restart plan
+                    await self.changed.wait_for(
+                        lambda: not any(n in self.tasks for n in self.after[name])
+                    )
+                    while self.pending.get(name) == timestamp and (
+                        retry_at := limits.limiter.gate(self.store, name, timestamp)
+                    ):
+                        try:
+                            await asyncio.wait_for(
+                                self.changed.wait(), max(retry_at - time.time(), 0)
+                            )
+                        except asyncio.TimeoutError:
+                            pass
+                if self.pending.get(name) != timestamp:
+                    continue
+                del self.pending[name]
+                self.after.pop(name, None)
+                async with self.restarts:
+                    try:
+                        await self.restart(name, timestamp)
+                    except Exception:
+                        logging.exception(
+                            f"Unexpected error while handling container {name}."
+                        )
+        finally:
+            del self.tasks[name]
+            await self.notify()
+
+    async def notify(self):
+        async with self.changed:
+            self.changed.notify_all()
+
+    async def restart(self, name, timestamp):
+        try:
+            container = await self.inspect(name)
+            actions.check(name, container, timestamp)
+            if actions.must_recreate(self.store, container):
+                await asyncio.to_thread(self.recreate, name, timestamp)
+                return
+
+            logging.info(f"Restarting container {name}.")
+            try:
+                with metrics.action(name, "restart"):
+                    await self.http.request(
+                        "POST", f"/containers/{container.id}/restart"
+                    )
+            except APIError as err:
+                raise actions.CannotRestartError(
+                    f"Failed to restart container {name}. Error: {err}",
+                    "restart_failed",
+                )
+            await asyncio.to_thread(actions.restarted, self.host, container.id)
+        except actions.CannotRestartError as err:
+            actions.cannot_restart(name, err)
+
+
+def run(host, evaluate, recreate):
+    docker_utils.negotiate(host.client, host)
+    asyncio.run(Engine(host, evaluate, recreate).run())
@@ -1,8 +1,10 @@
+import functools
 import logging
 import os
 import sys
 from collections import ChainMap
-from enum import Enum
+from enum import Enum, Flag, auto
+from typing import NamedTuple
 
 _PREFIX = "restarter"
 
@@ -12,23 +14,60 @@ def _env(setting, default):
 
 
 def _parse_policy(policy):
-    return sorted(
-        [Policy(p.strip().lower()) for p in policy.split(",")], key=lambda p: p.value
-    )
+    flags = Policy(0)
+    for p in policy.split(","):
+        if p.strip():
+            flags |= Policy[p.strip().upper()]
+    return flags
 
 
 def _to_bool(s):
     return s.strip().lower() in ["yes", "true"]
 
 
-class Policy(Enum):
-    DEPENDENCY = "dependency"
-    UNHEALTHY = "unhealthy"
+class Rate(NamedTuple):
+    """At most `count` events per `seconds` seconds."""
+
+    count: int
+    seconds: int
+
+    def __str__(self):
+        return f"{self.count}/{self.seconds}"
+
+
+def _parse_rate(s):
+    """Parses `<count>/<seconds>`, an empty value means unlimited (None)."""
+    if not (s := s.strip()):
+        return None
+    count, _, seconds = s.partition("/")
+    rate = Rate(int(count), int(seconds))
+    if rate.count <= 0 or rate.seconds <= 0:
+        raise ValueError(f"Invalid rate {s}, both numbers have to be positive.")
+    return rate
+
+
+class Policy(Flag):
+    DEPENDENCY = auto()
+    UNHEALTHY = auto()
 
 
 class GlobalSetting(Enum):
-    CHECK_EVERY_SECONDS = (int, 60)
-    GC_EVERY_SECONDS = (int, 300)
+    # Led by an index, like `Setting`, so that members with the same parser and
+    # default don't become aliases of one another
+    CHECK_EVERY_SECONDS = (1, int, 60)
+    CHECK_MAX_SECONDS = (2, int, 300)
+    CHECK_MIN_SECONDS = (3, int, 10)
+    ENGINE = (4, lambda s: s.strip().lower(), "threads")
+    EVALUATION_WORKERS = (5, int, 0)
+    EVENT_DEBOUNCE_MS = (6, int, 500)
+    EVENT_MAX_LATENCY_MS = (7, int, 5000)
+    EVENT_QUEUE_SIZE = (8, int, 10000)
+    GLOBAL_RATE_LIMIT = (9, _parse_rate, "")
+    HOSTS = (10, str, "")
+    JOURNAL = (11, str.strip, "")
+    MAX_CONCURRENT_RESTARTS = (12, int, 4)
+    METRICS_PORT = (13, int, 0)
+    STATUS_PORT = (14, int, 0)
 
 
 class Setting(Enum):
@@ -36,11 +75,17 @@ class Setting(Enum):
     DEPENDS_ON = (3, str, "")
     NETWORK_MODE = (6, str, "")
     POLICY = (7, str, "dependency,unhealthy")
+    READY_TIMEOUT = (8, int, "60")
+    # The storm protection is opt-in, see `limits.Limiter`
+    BACKOFF = (9, int, "0")
+    BACKOFF_MAX = (10, int, "300")
+    RATE_LIMIT = (11, _parse_rate, "")
+    CIRCUIT_BREAKER = (12, _parse_rate, "")
 
 
 global_settings = {}
 for setting in GlobalSetting:
-    type_, default = setting.value
+    _, type_, default = setting.value
     global_settings[setting] = type_(_env(setting.name, default))
 
 defaults = {}
@@ -52,15 +97,95 @@ for setting in Setting:
         defaults[setting] = type_(_env(setting.name, default))
 
 
-def from_labels(labels):
-    config = {}
-    for setting in Setting:
-        key = f"{_PREFIX}.{setting.name.lower()}"
-        if key in labels:
-            config[setting] = setting.value[1](labels[key])
+class Target(NamedTuple):
+    """A parsed dependency reference: `container:<name>`, `service:<name>` or a bare name."""
+
+    kind: str
+    name: str
+
+    @classmethod
+    def parse(cls, value):
+        for kind in ("container", "service"):
+            if value.lower().startswith(f"{kind}:"):
+                return cls(kind, value.split(":", 1)[1])
+        return cls("bare", value)
+
+
+class Settings:
+    """Immutable settings of a container, indexable by `Setting` like a dict.
+
+    `targets` holds the references found in the container's own
+    `restarter.depends_on` and `restarter.network_mode` labels, `network_target`
+    the (possibly default) network mode used to recreate the container and
+    `invalid` the labels ignored because they couldn't be parsed.
+    """
+
+    __slots__ = tuple(s.name.lower() for s in Setting) + (
+        "targets",
+        "network_target",
+        "invalid",
+    )
+
+    def __init__(self, values, targets, invalid=()):
+        for setting in Setting:
+            object.__setattr__(self, setting.name.lower(), values[setting])
+        object.__setattr__(self, "targets", targets)
+        object.__setattr__(self, "invalid", invalid)
+        network_mode = values[Setting.NETWORK_MODE]
+        object.__setattr__(
+            self, "network_target", Target.parse(network_mode) if network_mode else None
+        )
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Settings are immutable.")
+
+    def __getitem__(self, setting):
+        return getattr(self, setting.name.lower())
+
+
+_LABELS = tuple(f"{_PREFIX}.{setting.name.lower()}" for setting in Setting)
+
+
+@functools.lru_cache(maxsize=1024)
+def _compile(values):
+    config, invalid = {}, []
+    for setting, value in zip(Setting, values):
+        if value is None:
+            continue
+        try:
+            config[setting] = setting.value[1](value)
             if setting == Setting.POLICY:
                 config[setting] = _parse_policy(config[setting])
-    return ChainMap(config, defaults)
+        except (ValueError, KeyError):
+            # Falls back to the default
+            config.pop(setting, None)
+            invalid.append(f"{_PREFIX}.{setting.name.lower()}={value}")
+    labels = dict(zip(Setting, values))
+    targets = tuple(
+        Target.parse(value)
+        for value in (labels[Setting.DEPENDS_ON] or "").split(",")
+        + [labels[Setting.NETWORK_MODE] or ""]
+        if value
+    )
+    return Settings(ChainMap(config, defaults), targets, tuple(invalid))
+
+
+def from_labels(labels, name=None):
+    """Returns the `Settings` of a container. Labels which can't be parsed fall back
+    to the default, with a warning naming the container if `name` is given."""
+    # Only the restarter.* labels are part of the key, a container's labels never
+    # change during its lifetime so this is computed once per container (config)
+    settings = _compile(tuple(labels.get(label, None) for label in _LABELS))
+    if settings.invalid and name is not None:
+        _warn_invalid(name, settings.invalid)
+    return settings
+
+
+@functools.lru_cache(maxsize=1024)
+def _warn_invalid(name, invalid):
+    logging.warning(
+        f"Ignoring invalid labels of container {name}, using the defaults instead: {', '.join(invalid)}."
+    )
 
 
 _SORTED_SETTINGS = sorted(
@@ -72,14 +197,14 @@ def dump(settings, message):
     for setting in _SORTED_SETTINGS:
         if setting in settings:
             if setting == Setting.POLICY:
-                message += f"\n  {setting.name.lower()} = {', '.join(p.value for p in settings[setting])}"
+                message += f"\n  {setting.name.lower()} = {', '.join(p.name.lower() for p in Policy if p in settings[setting])}"
             else:
                 value = settings[setting]
                 if isinstance(value, bool):
                     value = "yes" if value else "no"
                 elif isinstance(value, str) and not value:
                     value = "<empty>"
-                elif isinstance(value, int) and value == sys.maxsize:
+                elif (isinstance(value, int) and value == sys.maxsize) or value is None:
                     value = "unlimited"
                 message += f"\n  {setting.name.lower()} = {value}"
     logging.info(message)
@@ -1,12 +1,110 @@
+import contextvars
+import functools
 import logging
+import random
+import threading
 import time
+import urllib.parse
+from collections import OrderedDict
+from concurrent.futures import Future
 
 import docker
+import requests
 from docker.types import DeviceRequest, LogConfig, Mount, Ulimit
 
+import restarter.metrics as metrics
 
-def get_container_run_args(container, parent_id):
-    image = container.image
+
+# Image IDs are content addressable, hence inspect results never go stale: they are
+# only evicted when the cache is full or dropped when the image gets deleted
+class ImageCache:
+    def __init__(self, client, size):
+        self.client = client
+        self.size = size
+        self._lock = threading.Lock()
+        self._images = OrderedDict()
+        # Inspects in flight: concurrent misses of the same image wait for the first
+        self._loading = {}
+
+    def get(self, id):
+        with self._lock:
+            if id in self._images:
+                self._images.move_to_end(id)
+                metrics.IMAGE_CACHE.inc(result="hit")
+                return self._images[id]
+            loading = self._loading.get(id, None)
+            if loading is None:
+                self._loading[id] = Future()
+        if loading is not None:
+            metrics.IMAGE_CACHE.inc(result="coalesced")
+            return loading.result()
+        metrics.IMAGE_CACHE.inc(result="miss")
+        try:
+            image = self.client.images.get(id)
+        except Exception as err:
+            with self._lock:
+                self._loading.pop(id).set_exception(err)
+            raise
+        with self._lock:
+            self._images[id] = image
+            while len(self._images) > self.size:
+                self._images.popitem(last=False)
+            self._loading.pop(id).set_result(image)
+        return image
+
+    def invalidate(self, id):
+        with self._lock:
+            self._images.pop(id, None)
+
+
+IMAGE_CACHE_SIZE = 128
+
+
+# Run args only depend on the configuration of the container and on its image,
+# both fixed for a given container ID (barring `docker update`, hence `invalidate`)
+class RunArgsCache:
+    def __init__(self, images):
+        self.images = images
+        self._lock = threading.Lock()
+        self._run_args = {}
+
+    def get(self, container):
+        with self._lock:
+            if (run_args := self._run_args.get(container.id)) is not None:
+                return run_args
+        run_args = get_container_run_args(container, self.images)
+        with self._lock:
+            self._run_args[container.id] = run_args
+        return run_args
+
+    def prepare(self, containers):
+        """Computes ahead the run args of the containers which may get recreated, and
+        drops those of the containers which don't exist anymore (`containers` being
+        all of them), e.g. destroyed while the events were lost."""
+        with self._lock:
+            ids = {container.id for container in containers}
+            for id in self._run_args.keys() - ids:
+                del self._run_args[id]
+        for container in containers:
+            network_mode = container.attrs["HostConfig"].get("NetworkMode", "")
+            if not network_mode.startswith("container:"):
+                continue
+            try:
+                self.get(container)
+            except docker.errors.APIError as err:
+                # Computed again, or failing for good, when actually needed
+                logging.info(
+                    f"Failed to prepare the recreation of container {container.name}. Error: {err}"
+                )
+
+    def invalidate(self, id):
+        with self._lock:
+            self._run_args.pop(id, None)
+
+
+# The network mode of the container, `container:<parent id>`, is left to the caller
+def get_container_run_args(container, images):
+    image = images.get(container.attrs["Image"])
 
     run_args = {
         "image": image.id,
@@ -171,7 +269,6 @@ def get_container_run_args(container, parent_id):
 
     if container.attrs["HostConfig"]["NetworkMode"].startswith("container:"):
         run_args["hostname"] = ""
-        run_args["network_mode"] = f"container:{parent_id}"
 
     if container.attrs["Config"]["Entrypoint"] == image.attrs["Config"]["Entrypoint"]:
         run_args["entrypoint"] = None
@@ -214,15 +311,143 @@ def get_container_run_args(container, parent_id):
     return run_args
 
 
-client = docker.from_env()
+# Accepted by `containers.run` but not by `containers.create`
+_RUN_ONLY_ARGS = ("stdout", "stderr")
+
+
+def recreate(client, container, run_args):
+    """Replaces `container` by a new one created from `run_args`, returns it and the
+    duration of each phase.
+
+    `run_args` joins the network of another container (`container:<id>`), hence
+    can't conflict with the old container: the new one is created under a
+    temporary name beforehand, so that only the removal, a rename and the start
+    happen in between. The new container is never left under the temporary name:
+    it's removed if the old one can't be, and created again under the old name if
+    it can't be renamed.
+    """
+    timings = {}
+    create_args = {k: v for k, v in run_args.items() if k not in _RUN_ONLY_ARGS}
+    temporary_name = f"{container.name}-restarter-{container.id[:12]}"
+    with metrics.phase(timings, "create"):
+        try:
+            recreated = client.containers.create(
+                **{**create_args, "name": temporary_name}
+            )
+        except docker.errors.APIError as err:
+            if err.status_code != 409:
+                raise
+            # Left over by an interrupted recreation
+            client.containers.get(temporary_name).remove(force=True)
+            recreated = client.containers.create(
+                **{**create_args, "name": temporary_name}
+            )
+    try:
+        with metrics.phase(timings, "remove"):
+            container.remove(force=True)
+    except docker.errors.APIError:
+        recreated.remove(force=True)
+        raise
+    try:
+        with metrics.phase(timings, "rename"):
+            recreated.rename(container.name)
+    except docker.errors.APIError as err:
+        logging.info(
+            f"Failed to rename container {temporary_name} to {container.name}, creating it under that name instead. Error: {err}"
+        )
+        recreated.remove(force=True)
+        with metrics.phase(timings, "create"):
+            recreated = client.containers.create(
+                **{**create_args, "name": container.name}
+            )
+    with metrics.phase(timings, "start"):
+        recreated.start()
+    return recreated, timings
+
+
+def _instrument(api, host):
+    request = api.request
 
+    @functools.wraps(request)
+    def wrapper(method, url, *args, **kwargs):
+        with metrics.api_call(host, method, urllib.parse.urlparse(url).path):
+            return request(method, url, *args, **kwargs)
 
-def list_with_retry(*args, **kwargs):
+    api.request = wrapper
+
+
+def connect(url, host):
+    """Returns a client for the daemon at `url`, by default the one of DOCKER_HOST.
+
+    TLS settings (DOCKER_TLS_VERIFY, DOCKER_CERT_PATH) are taken from the
+    environment for every daemon. The client doesn't reach the daemon yet: its API
+    version is to be looked up with `negotiate`.
+    """
+    version = docker.constants.DEFAULT_DOCKER_API_VERSION
+    if url is None:
+        client = docker.from_env(version=version)
+    else:
+        client = docker.DockerClient(
+            **{**docker.utils.kwargs_from_env(), "base_url": url, "version": version}
+        )
+    _instrument(client.api, host)
+    return client
+
+
+def negotiate(client, host):
+    """Switches `client` to the API version of its daemon, as `version="auto"` would
+    have on creation, retrying until the daemon answers."""
+    attempt = 0
+    while True:
+        try:
+            client.api._version = client.api.version(api_version=False)["ApiVersion"]
+            return
+        except (docker.errors.APIError, requests.exceptions.ConnectionError) as err:
+            if isinstance(err, docker.errors.APIError) and not err.is_server_error():
+                raise
+            delay = backoff(attempt)
+            attempt += 1
+            logging.info(
+                f"Failed to reach host {host}. Retrying in {round(delay, 1)} seconds. Error: {err}"
+            )
+            time.sleep(delay)
+
+
+def backoff(attempt, *, base=1, cap=30):
+    """Exponential backoff with full jitter, bounded by `cap` seconds."""
+    return random.uniform(0, min(cap, base * 2**attempt))
+
+
+def list_with_retry(client, *args, **kwargs):
+    attempt = 0
     while True:
         try:
             return client.containers.list(*args, **kwargs)
-        except docker.errors.NotFound as err:
+        except (docker.errors.APIError, requests.exceptions.ConnectionError) as err:
+            if isinstance(err, docker.errors.APIError) and not err.is_server_error():
+                raise
+            delay = backoff(attempt)
+            attempt += 1
             logging.info(
-                f"Failed to retrieve containers. Retrying in one second. Error: {err}"
+                f"Failed to retrieve containers. Retrying in {round(delay, 1)} seconds. Error: {err}"
             )
-            time.sleep(1)
+            time.sleep(delay)
+
+
+INSPECT_CONCURRENCY = 8
+
+
+def get_many(client, ids, executor):
+    """Inspects the given containers concurrently, skipping the ones that don't exist anymore."""
+
+    def get_or_none(id):
+        try:
+            return client.containers.get(id)
+        except docker.errors.NotFound:
+            return None
+
+    # In the caller's context, for its `metrics.trace` if any
+    futures = [
+        executor.submit(contextvars.copy_context().run, get_or_none, id) for id in ids
+    ]
+    return [c for f in futures if (c := f.result()) is not None]
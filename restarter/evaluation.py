@@ -0,0 +1,108 @@
+import concurrent.futures
+import logging
+import multiprocessing
+import pickle
+
+import restarter.config as config
+import restarter.state as state
+
+# Kinds of findings, as (kind, container name, dependency name or None)
+UNHEALTHY = "unhealthy"
+DEPENDENCY_DOWN = "dependency_down"
+STARTED_BEFORE = "started_before"
+
+# Below this many containers to evaluate, shipping the columns to the workers costs
+# more than evaluating them in place
+SHARD_MIN_TARGETS = 5000
+
+_pool = None
+
+
+def start():
+    """Starts the pool of RESTARTER_EVALUATION_WORKERS processes, if more than one.
+
+    To be called before any thread is started: the workers are forked, since
+    spawned ones would run main.py again, and forking copies the locks held by
+    other threads.
+    """
+    global _pool
+    if config.global_settings[config.GlobalSetting.EVALUATION_WORKERS] < 2:
+        return
+    _pool = concurrent.futures.ProcessPoolExecutor(
+        config.global_settings[config.GlobalSetting.EVALUATION_WORKERS],
+        mp_context=multiprocessing.get_context("fork"),
+    )
+    # All of the workers are forked upon the first submission
+    _pool.submit(int).result()
+
+
+def evaluate(snapshot):
+    """Returns the findings about the containers to evaluate (`snapshot.targets`).
+
+    Once the pool is started (see `start`), large snapshots are evaluated by
+    RESTARTER_EVALUATION_WORKERS workers, each over a contiguous slice of the
+    targets, and the findings of the slices merge by concatenation. The columns
+    are pickled once for all of them: rows keep their numbers, so a target's
+    parents are found whichever slice it is in. Should the pool break, the
+    evaluation falls back to this process.
+    """
+    global _pool
+    columns = _columns(snapshot)
+    if (pool := _pool) is None or len(snapshot.targets) < SHARD_MIN_TARGETS:
+        return _evaluate(columns)
+    targets = len(snapshot.targets)
+    payload = pickle.dumps(columns, pickle.HIGHEST_PROTOCOL)
+    step = -(
+        -targets // config.global_settings[config.GlobalSetting.EVALUATION_WORKERS]
+    )
+    try:
+        futures = [
+            pool.submit(_evaluate_slice, payload, start, min(start + step, targets))
+            for start in range(0, targets, step)
+        ]
+        return [finding for future in futures for finding in future.result()]
+    except concurrent.futures.BrokenExecutor as err:
+        logging.info(
+            f"The evaluation workers failed, evaluating in this process from now on. Error: {err}"
+        )
+        _pool = None
+        return _evaluate(columns)
+
+
+def _columns(snapshot):
+    return (
+        snapshot.names,
+        snapshot.started_at,
+        snapshot.health,
+        snapshot.down,
+        snapshot.flags,
+        snapshot.offsets,
+        snapshot.parents,
+        snapshot.targets,
+    )
+
+
+def _evaluate_slice(payload, start, stop):
+    return _evaluate(pickle.loads(payload), range(start, stop))
+
+
+def _evaluate(columns, targets=None):
+    names, started_at, health, down, flags, offsets, parents, all_targets = columns
+    findings = []
+    for row in all_targets if targets is None else targets:
+        if not (row_flags := flags[row]) & state.ENABLED:
+            continue
+
+        if row_flags & state.UNHEALTHY_POLICY and health[row] == state.UNHEALTHY:
+            findings.append((UNHEALTHY, names[row], None))
+
+        if row_flags & state.DEPENDENCY:
+            row_started_at = started_at[row]
+            for parent in parents[offsets[row] : offsets[row + 1]]:
+                if down[parent]:
+                    findings.append((DEPENDENCY_DOWN, names[row], names[parent]))
+
+                if row_started_at <= started_at[parent]:
+                    findings.append((STARTED_BEFORE, names[row], names[parent]))
+
+    return findings
@@ -0,0 +1,213 @@
+import json
+import logging
+import queue
+import re
+import threading
+import time
+
+import docker
+import requests
+
+import restarter.docker_utils as docker_utils
+import restarter.metrics as metrics
+import restarter.state as state
+
+# Events which matter to the store, the scheduler or the caches, anything else is
+# filtered out by the daemon. `health_status` matches `health_status: <status>`.
+CONTAINER_EVENTS = state.STORE_EVENTS + ("update",)
+IMAGE_EVENTS = ("delete",)
+FILTERS = {
+    "type": ["container", "image"],
+    "event": list(CONTAINER_EVENTS + IMAGE_EVENTS),
+}
+
+# Handed out in place of the events dropped when the queue overflowed
+OVERFLOW = object()
+
+# Shorter lines are decoded in full, faster than picking their attributes
+FULL_DECODE_BELOW = 2048
+
+# The daemon encodes events compactly, with the fields of its `Message` struct in
+# order: `status` first and `scope` right after `Actor`. `{"` and `,"` can't occur
+# within a string, where quotes are escaped, so they mark keys.
+_STATUS = re.compile(rb'\{"status":"([^"\\]*)"')
+_ATTRIBUTES = b'"Attributes":'
+_ACTOR_END = b'},"scope":'
+_KEYS = {
+    key: (b'{"' + key.encode() + b'":"', b',"' + key.encode() + b'":"')
+    for key in ("name", "oldName")
+}
+# The contents of a string, up to its closing quote
+_STRING = re.compile(rb'[^"\\]*(?:\\.[^"\\]*)*')
+
+
+def since(time_nano):
+    """Formats an event's `timeNano` for the `since` parameter of `/events`."""
+    return f"{time_nano // 10**9}.{time_nano % 10**9:09d}"
+
+
+def _attribute(line, key, start, end):
+    """Returns the value of `key` in the attributes between `start` and `end`."""
+    for pattern in _KEYS[key]:
+        if (i := line.find(pattern, start, end)) >= 0:
+            value = _STRING.match(line, i + len(pattern)).group()
+            return json.loads(b'"' + value + b'"') if b"\\" in value else value.decode()
+    return None
+
+
+class Decoder:
+    """Decodes events, one JSON document per line, from chunks of a stream.
+
+    Events with a status other than `statuses` (up to the first colon, e.g.
+    `health_status`) are dropped before being decoded, in case the daemon ignored
+    the filters. The attributes of the actor, which hold all of its labels, aren't
+    decoded: only `name` and `oldName` are picked from them. Short lines, and lines
+    not laid out as expected, are decoded in full.
+    """
+
+    def __init__(self, statuses=CONTAINER_EVENTS + IMAGE_EVENTS):
+        self._statuses = {status.encode() for status in statuses}
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        """Returns the events completed by `data`."""
+        if not self._buffer and data.endswith(b"\n"):
+            # Chunks usually hold whole lines, no need to buffer them
+            lines = data[:-1].split(b"\n")
+        else:
+            self._buffer += data
+            if (end := self._buffer.rfind(b"\n")) < 0:
+                return []
+            lines = bytes(self._buffer[:end]).split(b"\n")
+            del self._buffer[: end + 1]
+        return [event for line in lines if (event := self.decode(line)) is not None]
+
+    def decode(self, line):
+        """Returns the event encoded by `line`, None if it's filtered out or blank."""
+        if (status := _STATUS.match(line)) is None:
+            if not line.strip():
+                return None
+            event = json.loads(line.decode())
+            if "status" in event and not self._wanted(event["status"].encode()):
+                return None
+            return event
+        if not self._wanted(status[1]):
+            return None
+        if len(line) < FULL_DECODE_BELOW:
+            return json.loads(line.decode())
+        start, end = line.find(_ATTRIBUTES), line.rfind(_ACTOR_END)
+        if start < 0 or end < start:
+            return json.loads(line.decode())
+        start += len(_ATTRIBUTES)
+        event = json.loads((line[:start] + b"{}" + line[end:]).decode())
+        attributes = event["Actor"]["Attributes"]
+        for key in _KEYS:
+            if (value := _attribute(line, key, start, end)) is not None:
+                attributes[key] = value
+        return event
+
+    def _wanted(self, status):
+        return status.partition(b":")[0] in self._statuses
+
+
+class Subscription:
+    """Events of a host, read into a bounded queue by a thread of its own.
+
+    The stream is reopened whenever it breaks, resuming from the last event read
+    (or from `time_nano`, initially) if any. When there is nothing to resume from
+    or when the consumer falls `size` events behind, OVERFLOW is handed out (in
+    place of the queued events): the consumer has to find out what happened with a
+    full resync.
+    """
+
+    def __init__(self, host, *, size, time_nano=None):
+        self.host = host
+        self._queue = queue.Queue(size)
+        # Latest `timeNano` read, and the events read at that time
+        self._last = time_nano
+        self._seen = set()
+        # Where the current stream resumed from, until it gets past it
+        self._replayed = None
+        threading.Thread(
+            name=host.thread_name("events-reader"), target=self._read, daemon=True
+        ).start()
+
+    def __iter__(self):
+        while True:
+            event = self._queue.get()
+            metrics.EVENT_QUEUE.set(self._queue.qsize(), host=self.host.name)
+            yield event
+
+    def _read(self):
+        attempt, resync = 0, False
+        while True:
+            try:
+                if self._last is not None:
+                    self._replayed = (self._last, set(self._seen))
+                stream = self.host.client.events(
+                    decode=False,
+                    filters=FILTERS,
+                    since=since(self._last) if self._last is not None else None,
+                )
+                if resync:
+                    # Only once subscribed, not to miss what happens meanwhile
+                    self._put(OVERFLOW)
+                    resync = False
+                decoder = Decoder()
+                for chunk in stream:
+                    attempt = 0
+                    for event in decoder.feed(chunk):
+                        if not self._duplicate(event):
+                            self._track(event)
+                            self._put(event)
+                error = "the stream ended"
+            except (
+                requests.exceptions.RequestException,
+                docker.errors.DockerException,
+            ) as err:
+                error = err
+            resync = self._last is None
+            delay = docker_utils.backoff(attempt)
+            attempt += 1
+            metrics.EVENT_RECONNECTS.inc(host=self.host.name)
+            self.host.interval.tighten("reconnect")
+            logging.info(
+                f"Lost the events of host {self.host}. Reconnecting in {round(delay, 1)} seconds. Error: {error}"
+            )
+            time.sleep(delay)
+
+    def _duplicate(self, event):
+        """Whether a resumed stream is replaying `event`, read before it broke."""
+        if self._replayed is None or (time_nano := event.get("timeNano")) is None:
+            return False
+        resumed_from, seen = self._replayed
+        if time_nano > resumed_from:
+            self._replayed = None
+            return False
+        return time_nano < resumed_from or (event.get("id"), event["status"]) in seen
+
+    def _track(self, event):
+        # Events aren't strictly ordered by time, resuming from the latest one is
+        # the best we can do
+        if (time_nano := event.get("timeNano")) is None:
+            return
+        if self._last is None or time_nano > self._last:
+            self._last, self._seen = time_nano, set()
+        if time_nano == self._last:
+            self._seen.add((event.get("id"), event["status"]))
+
+    def _put(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except queue.Full:
+            metrics.EVENT_OVERFLOWS.inc(host=self.host.name)
+            logging.info(
+                f"Fell {self._queue.maxsize} events behind on host {self.host}. Dropping them in favour of a full resync."
+            )
+            while True:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            self._queue.put_nowait(OVERFLOW)
+        metrics.EVENT_QUEUE.set(self._queue.qsize(), host=self.host.name)
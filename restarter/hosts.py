@@ -0,0 +1,93 @@
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+import restarter.config as config
+import restarter.docker_utils as docker_utils
+import restarter.polling as polling
+import restarter.state as state
+
+
+class Host:
+    """A supervised Docker daemon.
+
+    Every host has its own API client, container store, image and run args caches,
+    pools of inspect and restart threads and interval between periodic checks, so
+    that a slow daemon doesn't hold up the others.
+    `url` is None for the daemon configured through DOCKER_HOST.
+    """
+
+    def __init__(self, name, url, *, qualified):
+        self.name = name
+        self.url = url
+        # With several hosts, containers and threads are named after their host
+        self.qualified = qualified
+        self.client = docker_utils.connect(url, name)
+        self.images = docker_utils.ImageCache(
+            self.client, docker_utils.IMAGE_CACHE_SIZE
+        )
+        self.run_args = docker_utils.RunArgsCache(self.images)
+        self.store = state.Store(
+            self.client,
+            ThreadPoolExecutor(
+                max_workers=docker_utils.INSPECT_CONCURRENCY,
+                thread_name_prefix=self.thread_name("inspect"),
+            ),
+        )
+        self.executor = ThreadPoolExecutor(
+            max_workers=config.global_settings[
+                config.GlobalSetting.MAX_CONCURRENT_RESTARTS
+            ],
+            thread_name_prefix=self.thread_name("restart"),
+        )
+        self.interval = polling.Interval(
+            name,
+            minimum=config.global_settings[config.GlobalSetting.CHECK_MIN_SECONDS],
+            maximum=config.global_settings[config.GlobalSetting.CHECK_MAX_SECONDS],
+            initial=config.global_settings[config.GlobalSetting.CHECK_EVERY_SECONDS],
+        )
+
+    def thread_name(self, kind):
+        return f"{kind}-{self.name}" if self.qualified else kind
+
+    def __str__(self):
+        return self.name
+
+
+class Ref(NamedTuple):
+    """A container of a given host, the unit of work of the scheduler."""
+
+    host: Host
+    name: str
+
+    def __str__(self):
+        return f"{self.host.name}/{self.name}" if self.host.qualified else self.name
+
+
+def parse(value):
+    """Parses `[name=]url,...` into (name, url) pairs.
+
+    A host without name is named after the address of its daemon, or `local` for
+    a Unix socket.
+    """
+    hosts = []
+    for entry in value.split(","):
+        if not (entry := entry.strip()):
+            continue
+        name, separator, url = entry.partition("=")
+        if not separator or "://" in name:
+            name, url = "", entry
+        if not name:
+            name = urllib.parse.urlparse(url).hostname or "local"
+        hosts.append((name, url))
+    names = [name for name, _ in hosts]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Host names must be unique, got {', '.join(names)}.")
+    return hosts
+
+
+def from_config():
+    """Connects to the hosts listed in RESTARTER_HOSTS, by default to DOCKER_HOST."""
+    if not (hosts := parse(config.global_settings[config.GlobalSetting.HOSTS])):
+        return [Host("local", None, qualified=False)]
+    return [Host(name, url, qualified=len(hosts) > 1) for name, url in hosts]
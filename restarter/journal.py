@@ -0,0 +1,159 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+
+# Records appended before the journal is rewritten from its current state
+COMPACT_EVERY = 1000
+# Restarts kept per container, enough for the limiter's backoff and circuit breaker
+HISTORY_SIZE = 32
+# How often, at most, the event cursor of a host is written
+CURSOR_EVERY_SECONDS = 1
+
+
+class State:
+    """What the journal knows, keyed by (host name, container name).
+
+    `cursors` holds the `timeNano` of the last event seen per host, `pending` the
+    requests for action which weren't completed, as {timestamp: after}, and
+    `history` the times at which containers were restarted, as counted by the
+    limiter.
+    """
+
+    def __init__(self):
+        self.cursors = {}
+        self.pending = defaultdict(dict)
+        self.history = defaultdict(list)
+
+    def apply(self, record):
+        kind = record["type"]
+        if kind == "cursor":
+            self.cursors[record["host"]] = record["time"]
+            return
+        key = (record["host"], record["name"])
+        if kind == "submit":
+            self.pending[key][record["timestamp"]] = [tuple(a) for a in record["after"]]
+        elif kind == "restart":
+            self.history[key] = (self.history[key] + [record["at"]])[-HISTORY_SIZE:]
+        elif kind == "done":
+            self.pending[key].pop(record["timestamp"], None)
+            if not self.pending[key]:
+                del self.pending[key]
+
+    def prune(self, oldest):
+        """Forgets the restarts before `oldest`, and the containers left without any."""
+        for key in list(self.history):
+            if not (history := [at for at in self.history[key] if at >= oldest]):
+                del self.history[key]
+            else:
+                self.history[key] = history
+
+    def records(self):
+        """Returns the records reproducing this state."""
+        for host, time_nano in self.cursors.items():
+            yield {"type": "cursor", "host": host, "time": time_nano}
+        for (host, name), requests in self.pending.items():
+            for timestamp, after in requests.items():
+                yield {
+                    "type": "submit",
+                    "host": host,
+                    "name": name,
+                    "timestamp": timestamp,
+                    "after": after,
+                }
+        for (host, name), history in self.history.items():
+            for at in history:
+                yield {"type": "restart", "host": host, "name": name, "at": at}
+
+
+class Journal:
+    """Append-only record of the scheduling state, to survive restarts of restarter.
+
+    Containers are passed as `hosts.Ref`. Records are JSON lines, a truncated last
+    line (e.g. after a crash) is ignored. Every COMPACT_EVERY records the file is
+    atomically replaced by the records of the current state, without the restarts
+    older than `retention()` seconds, if given, which don't count anymore.
+    """
+
+    def __init__(self, path, retention=None):
+        self.path = path
+        self._retention = retention
+        self._lock = threading.Lock()
+        self._state = State()
+        self._cursor_written = {}
+        self._appended = 0
+        self._file = None
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        self._state.apply(json.loads(line))
+                    except (ValueError, KeyError):
+                        logging.info(f"Skipping invalid journal record: {line!r}")
+        self._compact()
+
+    def state(self):
+        """Returns the state loaded from the journal (and updated since)."""
+        return self._state
+
+    def cursor(self, host, time_nano):
+        now = time.time()
+        if now - self._cursor_written.get(host, 0) < CURSOR_EVERY_SECONDS:
+            # Written with the next cursor or when the journal is compacted
+            with self._lock:
+                self._state.cursors[host] = time_nano
+            return
+        self._cursor_written[host] = now
+        self._append({"type": "cursor", "host": host, "time": time_nano})
+
+    def submitted(self, ref, timestamp, after):
+        self._append(
+            {
+                "type": "submit",
+                "host": ref.host.name,
+                "name": ref.name,
+                "timestamp": timestamp,
+                "after": [[a.host.name, a.name] for a in after],
+            }
+        )
+
+    def restarted(self, ref, at):
+        self._append(
+            {"type": "restart", "host": ref.host.name, "name": ref.name, "at": at}
+        )
+
+    def done(self, ref, timestamp):
+        self._append(
+            {
+                "type": "done",
+                "host": ref.host.name,
+                "name": ref.name,
+                "timestamp": timestamp,
+            }
+        )
+
+    def _append(self, record):
+        with self._lock:
+            self._state.apply(record)
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+            self._appended += 1
+            if self._appended >= COMPACT_EVERY:
+                self._compact()
+
+    def _compact(self):
+        if self._retention is not None:
+            self._state.prune(time.time() - self._retention())
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            for record in self._state.records():
+                f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        if self._file is not None:
+            self._file.close()
+        self._file = open(self.path, "a")
+        self._appended = 0
@@ -0,0 +1,7 @@
+RESTARTER_DEPENDS_ON = "restarter.depends_on"
+RESTARTER_NETWORK_MODE = "restarter.network_mode"
+COMPOSE_CONFIG_FILES = "com.docker.compose.project.config_files"
+COMPOSE_DEPENDS_ON = "com.docker.compose.depends_on"
+COMPOSE_PROJECT = "com.docker.compose.project"
+COMPOSE_SERVICE = "com.docker.compose.service"
+COMPOSE_WORKING_DIR = "com.docker.compose.project.working_dir"
@@ -0,0 +1,221 @@
+import logging
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from types import MappingProxyType
+from typing import NamedTuple
+
+import restarter.config as config
+import restarter.metrics as metrics
+import restarter.readiness as readiness
+
+# How long restarts are remembered when `restarter.circuit_breaker` is unlimited
+HISTORY_SECONDS = 600
+
+
+class _Bucket:
+    """Token bucket holding up to `rate.count` tokens, refilled over `rate.seconds`."""
+
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, rate, now):
+        self.tokens = rate.count
+        self.updated = now
+
+    def available_at(self, rate, now):
+        """Returns None if a token is available, otherwise when one will be."""
+        self.tokens = min(
+            rate.count, self.tokens + (now - self.updated) * rate.count / rate.seconds
+        )
+        self.updated = now
+        if self.tokens >= 1:
+            return None
+        return now + (1 - self.tokens) * rate.seconds / rate.count
+
+
+class _State:
+    __slots__ = ("restarts", "bucket", "parked_until", "window")
+
+    def __init__(self):
+        self.restarts = deque()
+        self.bucket = None
+        self.parked_until = None
+        # How long restarts are remembered, as of the last `acquire`
+        self.window = HISTORY_SECONDS
+
+    def expired(self, now):
+        """Whether there's nothing left to remember."""
+        return (self.parked_until is None or self.parked_until <= now) and (
+            not self.restarts or self.restarts[-1] <= now - self.window
+        )
+
+
+class Limit(NamedTuple):
+    """Immutable copy of the state of a container, as published for inspection."""
+
+    restarts: tuple
+    tokens: float | None
+    parked_until: float | None
+
+
+class Limiter:
+    """Protects the daemon (and the containers) from restart storms.
+
+    Before a container is acted upon, `acquire` checks, in order:
+      - the circuit breaker (`restarter.circuit_breaker`), which parks a container
+        restarted `count` times within `seconds` seconds for `seconds` seconds;
+      - the exponential backoff between consecutive restarts of the container,
+        `restarter.backoff` seconds doubling up to `restarter.backoff_max`;
+      - the container's token bucket (`restarter.rate_limit`);
+      - the token bucket shared by all containers (RESTARTER_GLOBAL_RATE_LIMIT).
+    """
+
+    def __init__(self, rate):
+        self._lock = threading.Lock()
+        self._rate = rate
+        self._bucket = _Bucket(rate, time.time()) if rate else None
+        self._states = {}
+        # Keys of the containers which don't exist anymore, kept until expired
+        self._forgotten = set()
+        # The state of the containers, as {key: Limit}, and the tokens of the global
+        # bucket, swapped whenever a container is restarted, parked or forgotten
+        self.limits = MappingProxyType({})
+        self.global_tokens = self._bucket.tokens if self._bucket is not None else None
+
+    def gate(self, store, name, timestamp, key=None, restarted=None):
+        """`readiness.gate` followed by `acquire`, for use as the scheduler's gate.
+
+        Requests which turn out to have nothing to do don't count as restarts.
+        """
+        if (retry_at := readiness.gate(store, name, timestamp)) is not None:
+            return retry_at
+        container = store.find(name)
+        if (
+            container is None
+            or datetime.fromisoformat(container.attrs["State"]["StartedAt"]).timestamp()
+            > timestamp
+        ):
+            return None
+        return self.acquire(
+            key or name, config.from_labels(container.labels), restarted
+        )
+
+    def acquire(self, key, settings, restarted=None):
+        """Returns None and records a restart of `key` if allowed, otherwise when to ask again.
+
+        `restarted`, if given, is called with the time of the restart recorded.
+        """
+        now = time.time()
+        breaker = settings[config.Setting.CIRCUIT_BREAKER]
+        window = breaker.seconds if breaker else HISTORY_SECONDS
+        with self._lock:
+            state = self._states.setdefault(key, _State())
+            state.window = window
+            self._forgotten.discard(key)
+            restarts = state.restarts
+            while restarts and restarts[0] <= now - window:
+                restarts.popleft()
+
+            if state.parked_until is not None:
+                if now < state.parked_until:
+                    return self._throttled("circuit_open", state.parked_until)
+                logging.info(f"Container {key} is not parked anymore.")
+                state.parked_until = None
+                restarts.clear()
+            elif breaker and len(restarts) >= breaker.count:
+                state.parked_until = restarts[-1] + window
+                logging.info(
+                    f"Container {key} has been restarted {len(restarts)} times within {window} seconds. Parking it for {round(state.parked_until - now)} seconds."
+                )
+                self._publish(key)
+                return self._throttled("circuit_open", state.parked_until)
+
+            if restarts and (base := settings[config.Setting.BACKOFF]):
+                delay = min(
+                    base * 2 ** (len(restarts) - 1),
+                    settings[config.Setting.BACKOFF_MAX],
+                )
+                if now < restarts[-1] + delay:
+                    return self._throttled("backoff", restarts[-1] + delay)
+
+            if rate := settings[config.Setting.RATE_LIMIT]:
+                if state.bucket is None:
+                    state.bucket = _Bucket(rate, now)
+                if (available_at := state.bucket.available_at(rate, now)) is not None:
+                    return self._throttled("rate_limit", available_at)
+
+            if self._bucket is not None:
+                if (
+                    available_at := self._bucket.available_at(self._rate, now)
+                ) is not None:
+                    return self._throttled("global_rate_limit", available_at)
+                self._bucket.tokens -= 1
+
+            if state.bucket is not None:
+                state.bucket.tokens -= 1
+            restarts.append(now)
+            self._publish(key)
+        if restarted is not None:
+            restarted(now)
+        return None
+
+    def restore(self, key, restarts):
+        """Restores the times at which `key` was restarted, e.g. from the journal."""
+        with self._lock:
+            self._states.setdefault(key, _State()).restarts.extend(sorted(restarts))
+            self._publish(key)
+
+    def forget(self, key):
+        """Drops the state of a container which doesn't exist (by that name) anymore,
+        once its restarts don't count anymore: it may come back under the same name,
+        e.g. recreated."""
+        now = time.time()
+        with self._lock:
+            if key in self._states:
+                self._forgotten.add(key)
+            for expired in [k for k in self._forgotten if self._states[k].expired(now)]:
+                self._forgotten.discard(expired)
+                del self._states[expired]
+                self._publish(expired)
+
+    def longest_window(self):
+        """Returns how long, at most, restarts count for any container."""
+        default = config.defaults[config.Setting.CIRCUIT_BREAKER]
+        with self._lock:
+            return max(
+                [HISTORY_SECONDS, default.seconds if default else 0]
+                + [state.window for state in self._states.values()]
+            )
+
+    def _publish(self, key):
+        limits = dict(self.limits)
+        if (state := self._states.get(key, None)) is None:
+            limits.pop(key, None)
+        else:
+            limits[key] = Limit(
+                tuple(state.restarts),
+                state.bucket.tokens if state.bucket is not None else None,
+                state.parked_until,
+            )
+        self.limits = MappingProxyType(limits)
+        if self._bucket is not None:
+            self.global_tokens = self._bucket.tokens
+
+    def _throttled(self, reason, retry_at):
+        metrics.THROTTLED.inc(reason=reason)
+        return retry_at
+
+    def parked(self):
+        """Returns the number of containers currently parked by their circuit breaker."""
+        now = time.time()
+        with self._lock:
+            return sum(
+                1
+                for s in self._states.values()
+                if s.parked_until is not None and s.parked_until > now
+            )
+
+
+limiter = Limiter(config.global_settings[config.GlobalSetting.GLOBAL_RATE_LIMIT])
+metrics.PARKED.set_function(limiter.parked)
@@ -0,0 +1,322 @@
+import contextvars
+import functools
+import logging
+import re
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in labels) + "}"
+
+
+class _Metric:
+    type_ = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple((name, labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type_}"]
+        for name, labels, value in self._samples():
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    type_ = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    type_ = "gauge"
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self._function = None
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def set_function(self, function):
+        """Reads the (unlabelled) value from `function` at scrape time."""
+        self._function = function
+
+    def _samples(self):
+        if self._function is not None:
+            return [(self.name, (), self._function())]
+        return super()._samples()
+
+
+class Histogram(_Metric):
+    type_ = "histogram"
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = [[0] * len(self.BUCKETS), 0, 0.0]
+            buckets, _, _ = entry = self._values[key]
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    buckets[i] += 1
+            entry[1] += 1
+            entry[2] += value
+
+    def time(self, **labels):
+        """Decorator observing the duration of each call."""
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - start, **labels)
+
+            return wrapper
+
+        return decorator
+
+    def _samples(self):
+        samples = []
+        with self._lock:
+            for key, (buckets, count, sum_) in self._values.items():
+                for bound, value in zip(self.BUCKETS, buckets):
+                    samples.append(
+                        (f"{self.name}_bucket", key + (("le", bound),), value)
+                    )
+                samples.append((f"{self.name}_bucket", key + (("le", "+Inf"),), count))
+                samples.append((f"{self.name}_count", key, count))
+                samples.append((f"{self.name}_sum", key, sum_))
+        return samples
+
+
+CHECK_DURATION = Histogram(
+    "restarter_check_duration_seconds",
+    "Duration of the containers checks.",
+    ["host", "kind"],
+)
+CHECK_INTERVAL = Gauge(
+    "restarter_check_interval_seconds",
+    "Current interval between the periodic containers checks.",
+    ["host"],
+)
+CHECK_TIGHTENED = Counter(
+    "restarter_check_interval_tightened_total",
+    "Times the interval between the periodic checks was brought back to its minimum, by reason.",
+    ["host", "reason"],
+)
+DRIFTS = Counter(
+    "restarter_drifts_total",
+    "Periodic checks which found the containers in a state the events didn't tell about.",
+    ["host"],
+)
+API_REQUESTS = Counter(
+    "restarter_docker_api_requests_total",
+    "Requests sent to the Docker Engine API.",
+    ["host", "endpoint"],
+)
+API_DURATION = Histogram(
+    "restarter_docker_api_request_duration_seconds",
+    "Latency of the requests sent to the Docker Engine API.",
+    ["host", "endpoint"],
+)
+EVENT_LAG = Gauge(
+    "restarter_event_lag_seconds",
+    "Delay between an event being emitted by the daemon and being handled.",
+    ["host"],
+)
+EVENT_QUEUE = Gauge(
+    "restarter_event_queue_depth",
+    "Events read from the daemon and waiting to be handled.",
+    ["host"],
+)
+EVENT_OVERFLOWS = Counter(
+    "restarter_event_queue_overflows_total",
+    "Times the events queue overflowed, each followed by a full resync.",
+    ["host"],
+)
+EVENT_RECONNECTS = Counter(
+    "restarter_event_stream_reconnects_total",
+    "Times the events stream was reopened after breaking.",
+    ["host"],
+)
+HOST_FAILURES = Counter(
+    "restarter_host_failures_total",
+    "Unexpected errors of a host's threads, each followed by a retry of what failed.",
+    ["host", "thread"],
+)
+EVENTS = Counter(
+    "restarter_events_total",
+    "Container events received from the daemon.",
+    ["host", "status"],
+)
+QUEUE_DEPTH = Gauge(
+    "restarter_pending_actions",
+    "Containers waiting to be acted upon.",
+)
+ACTIONS = Counter(
+    "restarter_actions_total",
+    "Restarts and recreations of containers.",
+    ["container", "action"],
+)
+ACTION_DURATION = Histogram(
+    "restarter_action_duration_seconds",
+    "Duration of the restarts and recreations of containers.",
+    ["container", "action"],
+)
+BATCHES = Counter(
+    "restarter_batches_total",
+    "Batches of containers acted upon together, for the same check or event.",
+)
+BATCH_CALLS = Counter(
+    "restarter_batch_api_calls_total",
+    "API calls made to act upon the batches of containers.",
+    ["endpoint"],
+)
+RECREATE_PHASE = Histogram(
+    "restarter_recreate_phase_seconds",
+    "Duration of each phase of the recreations of containers.",
+    ["phase"],
+)
+IMAGE_CACHE = Counter(
+    "restarter_image_cache_lookups_total",
+    "Lookups in the image inspect cache.",
+    ["result"],
+)
+CANNOT_RESTART = Counter(
+    "restarter_cannot_restart_total",
+    "Actions which were given up, by reason.",
+    ["reason"],
+)
+THROTTLED = Counter(
+    "restarter_throttled_total",
+    "Actions held back by the restart storm protection, by reason.",
+    ["reason"],
+)
+PARKED = Gauge(
+    "restarter_parked_containers",
+    "Containers parked by their circuit breaker.",
+)
+
+
+_OBJECT_ID = re.compile(r"/(containers|images)/(?!json$|create$)[^/]+")
+
+
+def endpoint(method, path):
+    """Turns a request into a low cardinality label, e.g. `GET /containers/{id}/json`."""
+    path = re.sub(r"^/v[0-9.]+", "", path)
+    return f"{method} {_OBJECT_ID.sub(lambda m: f'/{m.group(1)}/{{id}}', path)}"
+
+
+# Counter of the API calls being traced in the current context, if any
+_traced = contextvars.ContextVar("traced", default=None)
+_traced_lock = threading.Lock()
+
+
+@contextmanager
+def trace(calls):
+    """Counts the API calls made within the block into the `collections.Counter`
+    `calls`, by endpoint, including those of the work it hands to other threads
+    in a copy of its context (see `docker_utils.get_many`)."""
+    token = _traced.set(calls)
+    try:
+        yield calls
+    finally:
+        _traced.reset(token)
+
+
+@contextmanager
+def api_call(host, method, path):
+    label = endpoint(method, path)
+    API_REQUESTS.inc(host=host, endpoint=label)
+    if (calls := _traced.get()) is not None:
+        with _traced_lock:
+            calls[label] += 1
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        API_DURATION.observe(time.perf_counter() - start, host=host, endpoint=label)
+
+
+@contextmanager
+def action(container, kind):
+    """Counts and times a successful restart or recreation."""
+    start = time.perf_counter()
+    yield
+    ACTIONS.inc(container=container, action=kind)
+    ACTION_DURATION.observe(
+        time.perf_counter() - start, container=container, action=kind
+    )
+
+
+@contextmanager
+def phase(timings, name):
+    """Times a phase of a recreation into `timings`, by name, and RECREATE_PHASE."""
+    start = time.perf_counter()
+    yield
+    timings[name] = duration = time.perf_counter() - start
+    RECREATE_PHASE.observe(duration, phase=name)
+
+
+def observe_event(host, event):
+    EVENTS.inc(host=host, status=event["status"].split(":")[0])
+    if "timeNano" in event:
+        EVENT_LAG.set(max(time.time() - event["timeNano"] / 1e9, 0), host=host)
+
+
+def render():
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port):
+    server = ThreadingHTTPServer(("", port), _Handler)
+    threading.Thread(name="metrics", target=server.serve_forever, daemon=True).start()
+    logging.info(f"Serving metrics on port {port}.")
@@ -0,0 +1,42 @@
+import logging
+
+
+def waves(store, names):
+    """Sorts the containers to restart in waves.
+
+    Every container comes after the containers it depends on, the containers of
+    the same wave don't depend on each other and can be acted upon in parallel.
+    """
+    containers = {}
+    plan = [[]]
+    for name in names:
+        if (container := store.find(name)) is not None:
+            containers[container.id] = container
+        else:
+            plan[0].append(name)
+
+    parents = {
+        id: {p.id for p in store.parents(id) if p.id in containers} for id in containers
+    }
+    while parents:
+        wave = [id for id, ps in parents.items() if not ps]
+        if not wave:
+            names = ", ".join(sorted(containers[id].name for id in parents))
+            logging.info(f"Circular dependency between containers {names}.")
+            wave = list(parents)
+        for id in wave:
+            del parents[id]
+        for ps in parents.values():
+            ps.difference_update(wave)
+        plan[-1].extend(containers[id].name for id in wave)
+        plan.append([])
+
+    return [sorted(wave) for wave in plan if wave]
+
+
+def log(plan):
+    if len(plan) > 1:
+        logging.info(
+            "Restart plan: "
+            + "; ".join(f"wave {i + 1}: {', '.join(w)}" for i, w in enumerate(plan))
+        )
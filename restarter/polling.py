@@ -0,0 +1,59 @@
+import logging
+import threading
+import time
+
+import restarter.metrics as metrics
+
+
+class Interval:
+    """Time between the periodic checks of a host, between `minimum` and `maximum`.
+
+    Periodic checks only correct what the events missed: each check which found no
+    drift doubles the interval, up to `maximum`. A drift, a reconnection of the
+    event stream or a restart bring it back to `minimum`, and cut short the wait
+    for the next check accordingly. It only starts growing again after a check.
+    The bounds are widened to `initial` if it's out of them.
+    """
+
+    def __init__(self, host, *, minimum, maximum, initial):
+        self.host = host
+        self.minimum = min(minimum, initial)
+        self.maximum = max(maximum, initial)
+        self.seconds = initial
+        self._tightened = False
+        self._condition = threading.Condition()
+        metrics.CHECK_INTERVAL.set(self.seconds, host=host)
+
+    def tighten(self, reason):
+        """Brings the interval back to `minimum`, e.g. after a reconnection."""
+        with self._condition:
+            self._tightened = True
+            if self.seconds > self.minimum:
+                metrics.CHECK_TIGHTENED.inc(host=self.host, reason=reason)
+                self._set(self.minimum, reason)
+                self._condition.notify_all()
+
+    def checked(self, drift):
+        """Adapts the interval to a check, which corrected a drift or not."""
+        with self._condition:
+            if drift:
+                metrics.DRIFTS.inc(host=self.host)
+                self._set(self.minimum, "drift")
+            elif not self._tightened:
+                self._set(min(self.seconds * 2, self.maximum), "no drift")
+            self._tightened = False
+
+    def wait(self):
+        """Waits for the next check to be due."""
+        start = time.time()
+        with self._condition:
+            while (timeout := start + self.seconds - time.time()) > 0:
+                self._condition.wait(timeout)
+
+    def _set(self, seconds, reason):
+        if seconds != self.seconds:
+            logging.info(
+                f"Checking host {self.host} every {seconds} seconds ({reason})."
+            )
+        self.seconds = seconds
+        metrics.CHECK_INTERVAL.set(seconds, host=self.host)
@@ -0,0 +1,59 @@
+import logging
+import math
+import time
+from datetime import datetime
+
+import restarter.config as config
+
+# Time given to a container without healthcheck to settle after (re)starting
+SETTLE_SECONDS = 10
+
+
+def _started_at(container):
+    return datetime.fromisoformat(container.attrs["State"]["StartedAt"]).timestamp()
+
+
+def ready_at(container, since):
+    """Returns None if the container is ready, otherwise when to check again.
+
+    A container with a healthcheck is ready once healthy, which we learn from its
+    `health_status` events, so there's nothing to re-check before the next event.
+    A container without healthcheck is ready once it's been running for
+    SETTLE_SECONDS, counting from `since` at the earliest.
+    """
+    state = container.attrs["State"]
+    if state["Status"] != "running":
+        return math.inf
+    if "Health" in state:
+        return None if state["Health"]["Status"] == "healthy" else math.inf
+    settled_at = max(_started_at(container), since) + SETTLE_SECONDS
+    return None if settled_at <= time.time() else settled_at
+
+
+def gate(store, name, timestamp):
+    """Returns None if container `name` can be acted upon, otherwise when to check again.
+
+    Containers without dependencies are given SETTLE_SECONDS after the request to
+    settle, the others wait until their dependencies are ready or until
+    `restarter.ready_timeout` seconds have passed since the request.
+    """
+    now = time.time()
+    if (container := store.find(name)) is None or _started_at(container) > timestamp:
+        # Nothing to wait for, the action will find out there's nothing to do
+        return None
+
+    if not (parents := store.parents(container.id)):
+        due = timestamp + SETTLE_SECONDS
+        return None if due <= now else due
+
+    retry_at = [r for p in parents if (r := ready_at(p, timestamp)) is not None]
+    if not retry_at:
+        return None
+
+    timeout = config.from_labels(container.labels)[config.Setting.READY_TIMEOUT]
+    if now >= (deadline := timestamp + timeout):
+        logging.info(
+            f"Dependencies of container {name} are not ready after {timeout} seconds. Proceeding anyway."
+        )
+        return None
+    return min(min(retry_at), deadline)
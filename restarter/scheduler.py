@@ -0,0 +1,331 @@
+import heapq
+import itertools
+import logging
+import queue
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+from types import MappingProxyType
+from typing import NamedTuple
+
+import restarter.metrics as metrics
+
+# Stale entries tolerated in the delay queue, beyond one per record
+COMPACT_QUEUE_ABOVE = 64
+
+
+class Record:
+    """Per-container scheduling state, owned by the scheduler thread."""
+
+    __slots__ = (
+        "name",
+        "recent_status",
+        "pending",
+        "after",
+        "running",
+        "retired",
+        "outcome",
+        "done_at",
+        "queued",
+    )
+
+    def __init__(self, name):
+        self.name = name
+        self.recent_status = deque([None, None], maxlen=2)
+        # Timestamp of the pending request for action, further requests are coalesced
+        self.pending = None
+        # Containers which have to be acted upon before this one
+        self.after = ()
+        self.running = False
+        self.retired = False
+        # What the last action returned, and when it completed
+        self.outcome = None
+        self.done_at = None
+        # (due, seq) of its entry in the delay queue, the others there are stale
+        self.queued = None
+
+    def idle(self):
+        return self.pending is None and not self.running
+
+    def view(self):
+        return View(
+            self.name,
+            tuple(self.recent_status),
+            self.pending,
+            self.after,
+            self.running,
+            self.outcome,
+            self.done_at,
+        )
+
+
+class View(NamedTuple):
+    """Immutable copy of a `Record`, as published to the other threads."""
+
+    name: object
+    recent_status: tuple
+    pending: float | None
+    after: tuple
+    running: bool
+    outcome: str | None
+    done_at: float | None
+
+
+class Batch:
+    """Containers dispatched together for requests made at the same `timestamp`,
+    e.g. a wave of a restart plan.
+
+    Their actions run concurrently and share work through `once`. The API calls
+    they make are counted into `calls`, by endpoint, and logged once they are all
+    done.
+    """
+
+    def __init__(self, timestamp, names):
+        self.timestamp = timestamp
+        self.names = names
+        self.calls = Counter()
+        # Owned by the scheduler thread
+        self.remaining = len(names)
+        self._lock = threading.Lock()
+        self._results = {}
+
+    def once(self, key, func):
+        """Returns what `func()` returns (or raises), called by the first caller with
+        `key` only: the others wait for it."""
+        with self._lock:
+            first = key not in self._results
+            if first:
+                self._results[key] = Future()
+            future = self._results[key]
+        if first:
+            try:
+                future.set_result(func())
+            except Exception as err:
+                future.set_exception(err)
+        return future.result()
+
+
+class Scheduler:
+    """Runs `action(name, timestamp, batch)` on the executor returned by
+    `executor(name)`. Containers are identified by `name`, which can be any
+    hashable (`hosts.Ref`).
+    What the action returns is recorded as the outcome, `error` if it raises.
+    The requests made at the same timestamp which are dispatched together are
+    handed the same `Batch`.
+
+    Requests are kept in a delay queue keyed by the earliest time they may be acted
+    upon. Requests for the same container are coalesced and a container is never
+    acted upon by more than one thread at a time. A request is held back until the
+    containers it comes `after` have been acted upon, which is how the waves of a
+    restart plan are sequenced, and until `gate(name, timestamp)` returns None;
+    otherwise the gate returns the time by which it wants to be asked again.
+    Held back requests are also re-evaluated whenever `poke` is called.
+
+    All the scheduling state is owned by the scheduler thread, the public methods
+    only post messages to it and never block. The state is published to the other
+    threads as `records`, an immutable snapshot swapped after each change.
+    Requests and completions are recorded in `journal`, if any.
+    """
+
+    def __init__(self, action, *, executor, gate, journal=None):
+        self._action = action
+        self._executor = executor
+        self._gate = gate
+        self._journal = journal
+        self._inbox = queue.SimpleQueue()
+        self._records = {}
+        self._dirty = set()
+        self._queue = []
+        self._waiting = set()
+        self._seq = itertools.count()
+        self.records = MappingProxyType({})
+        threading.Thread(name="scheduler", target=self._run, daemon=True).start()
+
+    def submit(self, name, timestamp, after=()):
+        self._inbox.put((self._submit, name, timestamp, tuple(after)))
+
+    def submit_plan(self, plan, timestamp):
+        self._inbox.put((self._submit_plan, plan, timestamp))
+
+    def observe(self, name, status):
+        """Records a status reported for container `name`."""
+        self._inbox.put((self._observe, name, status))
+
+    def depth(self):
+        """Returns the number of containers waiting to be acted upon."""
+        return sum(1 for r in self.records.values() if r.pending is not None)
+
+    def forget(self, name):
+        """Drops the record of a container which doesn't exist (by that name) anymore."""
+        self._inbox.put((self._forget, name))
+
+    def poke(self):
+        """Re-evaluates the held back requests, e.g. after a container became ready."""
+        self._inbox.put((self._release,))
+
+    def _record(self, name):
+        if name not in self._records:
+            self._records[name] = Record(name)
+        self._dirty.add(name)
+        return self._records[name]
+
+    def _submit(self, name, timestamp, after):
+        record = self._record(name)
+        record.retired = False
+        # The earliest pending request wins, otherwise a container which keeps
+        # being reported would never get past its gate
+        if record.pending is not None:
+            return
+        record.pending = timestamp
+        record.after = after
+        if self._journal is not None:
+            self._journal.submitted(name, timestamp, after)
+        if not record.running:
+            logging.info(f"Action on container {name} scheduled.")
+            self._push(record, timestamp)
+
+    def _submit_plan(self, plan, timestamp):
+        previous = ()
+        for wave in plan:
+            for name in wave:
+                self._submit(name, timestamp, tuple(previous))
+            previous = wave
+
+    def _observe(self, name, status):
+        self._record(name).recent_status.append(status)
+
+    def _forget(self, name):
+        if (record := self._records.get(name, None)) is None:
+            return
+        if record.idle():
+            del self._records[name]
+            self._dirty.add(name)
+        else:
+            record.retired = True
+
+    def _done(self, name, timestamp, outcome, batch, calls):
+        if self._journal is not None:
+            self._journal.done(name, timestamp)
+        batch.calls.update(calls)
+        batch.remaining -= 1
+        if not batch.remaining:
+            self._traced(batch)
+        record = self._records[name]
+        record.running = False
+        record.outcome = outcome
+        record.done_at = time.time()
+        self._dirty.add(name)
+        if record.pending is not None:
+            self._push(record, time.time())
+        elif record.retired:
+            del self._records[name]
+        self._release()
+
+    def _traced(self, batch):
+        metrics.BATCHES.inc()
+        for endpoint, count in batch.calls.items():
+            metrics.BATCH_CALLS.inc(count, endpoint=endpoint)
+        logging.info(
+            f"Acted upon {len(batch.names)} container(s) with {batch.calls.total()} API calls ({', '.join(f'{count} {endpoint}' for endpoint, count in batch.calls.most_common())})."
+        )
+
+    def _blocked(self, record):
+        return any(
+            name in self._records and not self._records[name].idle()
+            for name in record.after
+        )
+
+    def _release(self):
+        for name in self._waiting:
+            record = self._records.get(name, None)
+            if record is not None and record.pending is not None:
+                self._push(record, time.time())
+        self._waiting.clear()
+
+    def _push(self, record, due):
+        if record.queued is not None and record.queued[0] <= due:
+            return
+        record.queued = (due, next(self._seq))
+        heapq.heappush(self._queue, (*record.queued, record.name, record.pending))
+        if len(self._queue) > 2 * len(self._records) + COMPACT_QUEUE_ABOVE:
+            # Superseded entries are only dropped when due, drop them now
+            self._queue = [
+                entry
+                for entry in self._queue
+                if (record := self._records.get(entry[2], None)) is not None
+                and record.queued == entry[:2]
+            ]
+            heapq.heapify(self._queue)
+
+    def _publish(self):
+        if not self._dirty:
+            return
+        records = dict(self.records)
+        for name in self._dirty:
+            if (record := self._records.get(name, None)) is not None:
+                records[name] = record.view()
+            else:
+                records.pop(name, None)
+        self._dirty.clear()
+        self.records = MappingProxyType(records)
+
+    def _receive(self):
+        """Handles the messages posted so far, waiting for one until the next due request."""
+        timeout = max(self._queue[0][0] - time.time(), 0) if self._queue else None
+        try:
+            message = self._inbox.get(timeout=timeout)
+        except queue.Empty:
+            return
+        while True:
+            handler, *args = message
+            handler(*args)
+            try:
+                message = self._inbox.get_nowait()
+            except queue.Empty:
+                return
+
+    def _dispatch(self):
+        ready = {}
+        while self._queue and self._queue[0][0] <= time.time():
+            due, seq, name, timestamp = heapq.heappop(self._queue)
+            record = self._records.get(name, None)
+            if record is None or record.queued != (due, seq):
+                continue
+            record.queued = None
+            # Superseded by a more recent request or already being acted upon
+            if record.running or record.pending != timestamp:
+                continue
+            if self._blocked(record):
+                self._waiting.add(name)
+                continue
+            if (retry_at := self._gate(name, timestamp)) is not None:
+                self._waiting.add(name)
+                self._push(record, retry_at)
+                continue
+            self._waiting.discard(name)
+            record.pending = None
+            record.after = ()
+            record.running = True
+            self._dirty.add(name)
+            ready.setdefault(timestamp, []).append(name)
+        for timestamp, names in ready.items():
+            batch = Batch(timestamp, names)
+            for name in names:
+                self._executor(name).submit(self._execute, name, timestamp, batch)
+
+    def _run(self):
+        while True:
+            self._receive()
+            self._dispatch()
+            self._publish()
+
+    def _execute(self, name, timestamp, batch):
+        outcome, calls = "error", Counter()
+        try:
+            with metrics.trace(calls):
+                outcome = self._action(name, timestamp, batch)
+        except Exception:
+            logging.exception(f"Unexpected error while handling container {name}.")
+        finally:
+            self._inbox.put((self._done, name, timestamp, outcome, batch, calls))
@@ -0,0 +1,532 @@
+import logging
+import re
+import threading
+import time
+from array import array
+from collections import defaultdict
+from datetime import datetime
+
+import docker
+
+import restarter.config as config
+import restarter.docker_utils as docker_utils
+from restarter.labels import COMPOSE_DEPENDS_ON, COMPOSE_PROJECT, COMPOSE_SERVICE
+
+# Events that can change what we know about a container
+STORE_EVENTS = ("start", "die", "health_status", "destroy", "rename")
+
+# A sparse listing doesn't reveal restarts which went unnoticed (same state, new
+# StartedAt), so every so often all containers are inspected anyway
+FULL_INSPECT_EVERY = 10
+
+# Containers looked up together with a listing filtered by their IDs, beyond which
+# all containers are listed
+FILTER_IDS_UP_TO = 100
+
+
+# Encodings of the `status` and `health` columns of a `Snapshot`
+STATUSES = ("created", "running", "paused", "restarting", "removing", "exited", "dead")
+RUNNING = STATUSES.index("running")
+HEALTHS = ("", "starting", "healthy", "unhealthy")
+UNHEALTHY = HEALTHS.index("unhealthy")
+
+# Bits of the `flags` column of a `Snapshot`
+ENABLED = 1
+DEPENDENCY = 2
+UNHEALTHY_POLICY = 4
+
+# How long a running container has been up for, as humanized in the `Status` of a
+# listing: `Less than a second`, `1 second`, `About a minute`, `3 hours`...
+_UPTIME = re.compile(
+    r"^Up (\d+|About an?|Less than a) (second|minute|hour|day|week|month|year)s?\b"
+)
+_UNITS = {
+    "second": 1,
+    "minute": 60,
+    "hour": 3600,
+    "day": 86400,
+    "week": 7 * 86400,
+    "month": 30 * 86400,
+    "year": 365 * 86400,
+}
+
+_TIMESTAMP = re.compile(r"^(.+T\d\d:\d\d:\d\d)(?:\.(\d+))?(Z|[+-]\d\d:\d\d)?$")
+
+
+def epoch_ns(value):
+    """Parses a Docker timestamp, RFC 3339 with up to nanoseconds, into epoch nanoseconds.
+
+    Earlier timestamps, e.g. `0001-01-01T00:00:00Z` for a container which has never
+    been started, are clamped to 0.
+    """
+    m = _TIMESTAMP.match(value)
+    offset = m.group(3) if m.group(3) not in (None, "Z") else "+00:00"
+    seconds = int(datetime.fromisoformat(m.group(1) + offset).timestamp())
+    return max(seconds * 10**9 + int((m.group(2) or "")[:9].ljust(9, "0")), 0)
+
+
+def _row(container):
+    """The columns of `container` in a `Snapshot`, computed once per inspect."""
+    state = container.attrs["State"]
+    settings = config.from_labels(container.labels, container.name)
+    flags = ENABLED if settings[config.Setting.ENABLE] else 0
+    if config.Policy.DEPENDENCY in settings[config.Setting.POLICY]:
+        flags |= DEPENDENCY
+    if config.Policy.UNHEALTHY in settings[config.Setting.POLICY]:
+        flags |= UNHEALTHY_POLICY
+    status = state["Status"]
+    health = state.get("Health", {}).get("Status", "")
+    return (
+        container.name,
+        epoch_ns(state["StartedAt"]),
+        STATUSES.index(status) if status in STATUSES else len(STATUSES),
+        HEALTHS.index(health) if health in HEALTHS else 0,
+        flags,
+    )
+
+
+class Snapshot:
+    """Columnar, immutable copy of a `Store`, to evaluate containers in one pass.
+
+    Row `i` describes container `ids[i]`: `names`, `started_at` (epoch
+    nanoseconds), `status` and `health` (indices of STATUSES and HEALTHS), `down`
+    (not running or unhealthy) and `flags` (ENABLED, DEPENDENCY, UNHEALTHY_POLICY).
+    The parents of row `i` are the rows `parents[offsets[i]:offsets[i + 1]]`.
+
+    Only the rows in `targets`, the first ones, are meant to be evaluated, the
+    others (if any) are there as parents and have no parents of their own.
+    """
+
+    def __init__(self, ids, rows, parents_of, targets):
+        self.ids = ids
+        self.targets = range(targets)
+        self.index = {id: i for i, id in enumerate(ids)}
+        names, started_at, status, health, flags = zip(*rows) if rows else ((),) * 5
+        self.names = list(names)
+        self.started_at = array("q", started_at)
+        self.status = bytearray(status)
+        self.health = bytearray(health)
+        self.flags = bytearray(flags)
+        self.down = bytearray(
+            s != RUNNING or h == UNHEALTHY for s, h in zip(self.status, self.health)
+        )
+        self.offsets = array("i", [0])
+        self.parents = array("i")
+        for id in ids[:targets]:
+            self.parents.extend(self.index[p] for p in parents_of(id))
+            self.offsets.append(len(self.parents))
+
+    def patched(self, id, row):
+        """Returns a copy with the columns of `id` replaced, sharing the edges."""
+        i = self.index[id]
+        copy = object.__new__(Snapshot)
+        copy.__dict__.update(self.__dict__)
+        for column, value in zip(
+            ("names", "started_at", "status", "health", "flags"), row
+        ):
+            values = getattr(self, column)[:]
+            values[i] = value
+            setattr(copy, column, values)
+        copy.down = self.down[:]
+        copy.down[i] = copy.status[i] != RUNNING or copy.health[i] == UNHEALTHY
+        return copy
+
+
+def _summary_key(summary):
+    status = summary.get("Status", "")
+    if "(healthy)" in status:
+        health = "healthy"
+    elif "(unhealthy)" in status:
+        health = "unhealthy"
+    elif "(health: starting)" in status:
+        health = "starting"
+    else:
+        health = ""
+    return summary["Names"][0].lstrip("/"), summary["State"], health
+
+
+def _up_for(summary):
+    """Returns how long, at least, a listed container has been running, None if it isn't."""
+    if (m := _UPTIME.match(summary.get("Status", ""))) is None:
+        return None
+    count = int(m[1]) if m[1].isdigit() else 1 if m[1].startswith("About") else 0
+    unit = _UNITS[m[2]]
+    # Hours, and the larger units counted in hours, are rounded to the nearest one
+    return max(count * unit - (1800 if unit >= 3600 else 0), 0)
+
+
+def _container_key(container):
+    state = container.attrs["State"]
+    return (
+        container.name,
+        state["Status"],
+        state.get("Health", {}).get("Status", ""),
+    )
+
+
+def _checked_key(container):
+    return _container_key(container) + (container.attrs["State"]["StartedAt"],)
+
+
+def reference(container, target):
+    """Turns a `config.Target` of `container` into a (kind, key) reference.
+
+    Services are looked up in the container's own compose project, bare names are
+    services for compose containers and container names otherwise.
+    """
+    if target.kind == "container":
+        return "name", target.name
+    if target.kind == "service" or container.labels.get(COMPOSE_SERVICE, ""):
+        return "service", (container.labels.get(COMPOSE_PROJECT, None), target.name)
+    return "name", target.name
+
+
+def references(container):
+    """Returns the (kind, key) pairs a container depends on, kind being id, name or service."""
+    refs = set()
+
+    if (
+        network_mode := container.attrs["HostConfig"].get("NetworkMode", "")
+    ).startswith("container:"):
+        refs.add(("id", network_mode.split(":")[1]))
+
+    for depends_on in container.labels.get(COMPOSE_DEPENDS_ON, "").split(","):
+        if not depends_on:
+            continue
+        refs.add(
+            reference(container, config.Target("service", depends_on.split(":")[0]))
+        )
+
+    for target in config.from_labels(container.labels).targets:
+        refs.add(reference(container, target))
+
+    return refs
+
+
+class Store:
+    """In-memory view of the daemon's containers.
+
+    Seeded by a full listing and then kept up to date from the events stream with
+    targeted single-container inspects; `resync` is only meant to correct drift.
+    Alongside the containers it keeps a persistent dependency index so that the
+    parents and children of a container can be looked up without a full scan.
+    Containers are evaluated on a columnar `Snapshot`, cached until the store
+    changes and patched, rather than rebuilt, when only a container's state does.
+    """
+
+    def __init__(self, client, inspector):
+        self._client = client
+        # Executor the containers are inspected on during a resync
+        self._inspector = inspector
+        self._lock = threading.RLock()
+        self._containers = {}
+        self._seeded = False
+        self._resyncs = 0
+        # Resyncs of the store are one at a time
+        self._resyncing = threading.Lock()
+        # Bumped by every put and remove, and the value it took for each container,
+        # so that a resync doesn't roll back what it didn't see
+        self._sequence = 0
+        self._updated = {}
+        self._by_name = {}
+        # (project, service) -> ids in insertion order, the most recent one wins
+        self._by_service = defaultdict(dict)
+        # service -> ids across all projects, for references from outside compose
+        self._by_service_any = defaultdict(dict)
+        self._refs = {}
+        self._referrers = defaultdict(set)
+        # id -> (container, row), kept while the container isn't re-inspected
+        self._rows = {}
+        # Built on demand, dropped whenever the store changes
+        self._snapshot = None
+
+    def _index(self, container):
+        known = self._containers.get(container.id, None)
+        known_refs = self._refs.get(container.id, None)
+        snapshot, self._snapshot = self._snapshot, None
+        self._unindex(container.id)
+        self._containers[container.id] = container
+        cached = self._rows.get(container.id, None)
+        if cached is None or cached[0] is not container:
+            self._rows[container.id] = (container, _row(container))
+        self._by_name[container.name] = container.id
+        if service := container.labels.get(COMPOSE_SERVICE, None):
+            project = container.labels.get(COMPOSE_PROJECT, None)
+            self._by_service[(project, service)][container.id] = None
+            self._by_service_any[service][container.id] = None
+        self._refs[container.id] = references(container)
+        for ref in self._refs[container.id]:
+            self._referrers[ref].add(container.id)
+        if (
+            snapshot is not None
+            and known is not None
+            and known.name == container.name
+            and known.labels == container.labels
+            and known_refs == self._refs[container.id]
+        ):
+            # Only its state changed, the dependency graph is the same
+            self._snapshot = snapshot.patched(container.id, self._rows[container.id][1])
+
+    def _unindex(self, id):
+        if (container := self._containers.pop(id, None)) is None:
+            return
+        self._snapshot = None
+        if self._by_name.get(container.name) == id:
+            del self._by_name[container.name]
+        if service := container.labels.get(COMPOSE_SERVICE, None):
+            project = container.labels.get(COMPOSE_PROJECT, None)
+            for index, key in [
+                (self._by_service, (project, service)),
+                (self._by_service_any, service),
+            ]:
+                index[key].pop(id, None)
+                if not index[key]:
+                    del index[key]
+        for ref in self._refs.pop(id, ()):
+            self._referrers[ref].discard(id)
+            if not self._referrers[ref]:
+                del self._referrers[ref]
+
+    def _resolve(self, kind, key):
+        if kind == "id":
+            return self._containers.get(key, None)
+        if kind == "name":
+            return self._containers.get(self._by_name.get(key, None), None)
+        project, service = key
+        if project is None:
+            ids = self._by_service_any.get(service, None)
+        else:
+            ids = self._by_service.get(key, None)
+        if ids:
+            return self._containers[next(reversed(ids))]
+        return None
+
+    def resync(self):
+        with self._resyncing:
+            summaries = docker_utils.list_with_retry(
+                self._client, all=True, sparse=True
+            )
+            fresh, stale, since = self.diff([s.attrs for s in summaries])
+            return self.replace(
+                fresh + docker_utils.get_many(self._client, stale, self._inspector),
+                since,
+            )
+
+    def diff(self, summaries):
+        """Compares a sparse listing (`/containers/json`) with the store.
+
+        Returns the stored containers which are still up to date, the IDs of the
+        containers which need to be inspected and the point to pass to `replace`:
+        whatever is put or removed from then on is newer than the listing.
+        """
+        with self._lock:
+            full = self._resyncs % FULL_INSPECT_EVERY == 0
+            self._resyncs += 1
+            fresh, stale = [], []
+            for summary in summaries:
+                known = self._containers.get(summary["Id"], None)
+                if (
+                    not full
+                    and known is not None
+                    and _container_key(known) == _summary_key(summary)
+                ):
+                    fresh.append(known)
+                else:
+                    stale.append(summary["Id"])
+            return fresh, stale, self._sequence
+
+    def replace(self, containers, since=None):
+        """Replaces the whole content of the store with a fresh listing.
+
+        Containers put or removed after `since` (see `diff`) are kept as they are in
+        the store, the listing may predate them.
+        Returns whether it corrected a drift, i.e. differs from what the events told.
+        """
+        containers = {c.id: c for c in containers}
+        with self._lock:
+            if since is not None:
+                for id, sequence in self._updated.items():
+                    if sequence <= since:
+                        continue
+                    if id in self._containers:
+                        containers[id] = self._containers[id]
+                    else:
+                        containers.pop(id, None)
+            # Resyncs being one at a time, the next one starts from here
+            self._updated = {}
+            added = containers.keys() - self._containers.keys()
+            removed = self._containers.keys() - containers.keys()
+            # Only what the checks look at: the health check's log changes with
+            # every probe, without any event
+            changed = [
+                id
+                for id in containers.keys() & self._containers.keys()
+                if _checked_key(containers[id]) != _checked_key(self._containers[id])
+            ]
+            snapshot, self._snapshot = self._snapshot, None
+            for id in list(self._containers):
+                self._unindex(id)
+            for id in removed:
+                del self._rows[id]
+            for container in containers.values():
+                self._index(container)
+            if not (added or removed or changed):
+                # Same containers in the same states, hence the same columns
+                self._snapshot = snapshot
+            seeded, self._seeded = self._seeded, True
+        if seeded and (added or removed or changed):
+            logging.info(
+                f"Container state drift corrected: {len(added)} added, {len(removed)} removed, {len(changed)} changed."
+            )
+            return True
+        return False
+
+    def current(self, names, since):
+        """Returns the named containers as they are now, as {name: container}.
+
+        Stored containers are checked against a single sparse listing: the ones in
+        the same state, and running since before `since`, are returned as they are
+        (a restart after `since` would only show in their `StartedAt`). The others,
+        and the ones not in the store, are inspected. Containers which don't exist
+        anymore are left out.
+        """
+        with self._lock:
+            known = {name: self._resolve("name", name) for name in names}
+        listed = {}
+        if len(names) > 1 and (ids := [c.id for c in known.values() if c is not None]):
+            # Filtered by ID unless that would make the URL too long
+            filters = {"id": ids} if len(ids) <= FILTER_IDS_UP_TO else None
+            summaries = docker_utils.list_with_retry(
+                self._client, all=True, sparse=True, filters=filters
+            )
+            listed = {s.id: s.attrs for s in summaries}
+        listed_at = time.time()
+        current, stale = {}, []
+        for name, container in known.items():
+            summary = listed.get(container.id, None) if container is not None else None
+            if (
+                summary is not None
+                and _container_key(container) == _summary_key(summary)
+                and (up_for := _up_for(summary)) is not None
+                and listed_at - up_for < since
+            ):
+                current[name] = container
+            else:
+                stale.append(name)
+        for container in docker_utils.get_many(self._client, stale, self._inspector):
+            current[container.name] = container
+        return current
+
+    def containers(self):
+        with self._lock:
+            return list(self._containers.values())
+
+    def get(self, id):
+        with self._lock:
+            return self._containers.get(id, None)
+
+    def resolve(self, container, target):
+        """Returns the container a `config.Target` of `container` points to, if any."""
+        with self._lock:
+            return self._resolve(*reference(container, target))
+
+    def find(self, name):
+        with self._lock:
+            return self._resolve("name", name)
+
+    def _parents(self, id):
+        parents = {}
+        for ref in self._refs.get(id, ()):
+            if (parent := self._resolve(*ref)) is not None and parent.id != id:
+                parents[parent.id] = parent
+        return parents
+
+    def parents(self, id):
+        with self._lock:
+            return list(self._parents(id).values())
+
+    def snapshot(self, ids=None):
+        """Returns a `Snapshot` targeting all containers, or only the given ones
+        together with their (transitive) children, see `neighbourhood`."""
+        with self._lock:
+            if ids is None:
+                if self._snapshot is None:
+                    self._snapshot = self._build(list(self._containers))
+                return self._snapshot
+            # Not worth caching, nor rebuilding the whole store for
+            return self._build([c.id for c in self.neighbourhood(ids)])
+
+    def _build(self, targets):
+        parents = {id: self._parents(id) for id in targets}
+        ids = dict.fromkeys(targets)
+        for id in targets:
+            ids.update(dict.fromkeys(parents[id]))
+        return Snapshot(
+            list(ids), [self._rows[id][1] for id in ids], parents.get, len(targets)
+        )
+
+    def children(self, id):
+        with self._lock:
+            if (container := self._containers.get(id, None)) is None:
+                return []
+            keys = [("id", container.id), ("name", container.name)]
+            if service := container.labels.get(COMPOSE_SERVICE, None):
+                project = container.labels.get(COMPOSE_PROJECT, None)
+                keys.append(("service", (project, service)))
+                keys.append(("service", (None, service)))
+            children = {}
+            for key in keys:
+                for child_id in self._referrers.get(key, ()):
+                    if child_id != id and any(
+                        p.id == id for p in self.parents(child_id)
+                    ):
+                        children[child_id] = self._containers[child_id]
+            return list(children.values())
+
+    def neighbourhood(self, ids):
+        """Returns the given containers together with all their (transitive) children."""
+        with self._lock:
+            seen = {}
+            pending = [id for id in ids if id in self._containers]
+            while pending:
+                id = pending.pop()
+                if id in seen:
+                    continue
+                seen[id] = self._containers[id]
+                pending.extend(c.id for c in self.children(id))
+            return list(seen.values())
+
+    def refresh(self, id):
+        try:
+            container = self._client.containers.get(id)
+        except docker.errors.NotFound:
+            self.remove(id)
+            return None
+        self.put(container)
+        return container
+
+    def put(self, container):
+        with self._lock:
+            self._index(container)
+            self._touch(container.id)
+
+    def remove(self, id):
+        with self._lock:
+            self._unindex(id)
+            self._rows.pop(id, None)
+            self._touch(id)
+
+    def _touch(self, id):
+        self._sequence += 1
+        self._updated[id] = self._sequence
+
+    def update(self, event):
+        """Applies a container event. Returns whether the store was affected."""
+        status = event["status"].split(":")[0]
+        if status not in STORE_EVENTS:
+            return False
+        if status == "destroy":
+            self.remove(event["id"])
+        else:
+            self.refresh(event["id"])
+        return True
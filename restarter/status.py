@@ -0,0 +1,195 @@
+import functools
+import json
+import logging
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import MappingProxyType
+from typing import NamedTuple
+
+import restarter.state as state
+
+
+class Check(NamedTuple):
+    """The last check of a kind (`periodic` or `adhoc`) on a host."""
+
+    started_at: float
+    duration: float
+
+
+class Board:
+    """What restarter believes, published for the read-only status API.
+
+    The writers swap immutable values: the snapshot of the store evaluated by the
+    last full check of each host, the last restart plan, the timings of the last
+    checks, `scheduler.records` and `limiter.limits`, published by the scheduler
+    and the limiter themselves. Responses
+    are rendered from those and cached until they change: queries neither touch
+    the daemon nor take any lock of the writers.
+    """
+
+    def __init__(self):
+        # The scheduler whose records are served, if any
+        self.scheduler = None
+        # The `limits.Limiter` whose state is served, if any
+        self.limiter = None
+        # Between writers only
+        self._lock = threading.Lock()
+        self._graphs = MappingProxyType({})
+        self._plans = MappingProxyType({})
+        self._checks = MappingProxyType({})
+        self._cache = {}
+
+    def evaluated(self, host, snapshot):
+        """Publishes the `state.Snapshot` of all containers of `host`."""
+        self._publish("_graphs", host, snapshot)
+
+    def planned(self, host, timestamp, plan):
+        self._publish("_plans", host, (timestamp, plan))
+
+    def checked(self, host, kind, started_at, duration):
+        self._publish("_checks", (host, kind), Check(started_at, duration))
+
+    def time(self, host, kind):
+        """Decorator publishing the timing of each check."""
+
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                started_at = time.time()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.checked(host, kind, started_at, time.time() - started_at)
+
+            return wrapper
+
+        return decorator
+
+    def render(self, path):
+        """Returns the JSON body served at `path`, None if there is none."""
+        if path == "/graph":
+            to_json, sources = self._graph_json, (self._graphs,)
+        elif path == "/containers":
+            records = self.scheduler.records if self.scheduler is not None else None
+            to_json, sources = self._containers_json, (records,)
+        elif path == "/checks":
+            to_json, sources = self._checks_json, (self._checks, self._plans)
+        elif path == "/limits":
+            limiter = self.limiter
+            to_json, sources = self._limits_json, (
+                limiter.limits if limiter is not None else None,
+                limiter.global_tokens if limiter is not None else None,
+            )
+        else:
+            return None
+        cached = self._cache.get(path, None)
+        if cached is not None and all(a is b for a, b in zip(cached[0], sources)):
+            return cached[1]
+        body = json.dumps(to_json(*sources)).encode()
+        self._cache[path] = (sources, body)
+        return body
+
+    def _publish(self, attribute, key, value):
+        with self._lock:
+            setattr(
+                self,
+                attribute,
+                MappingProxyType({**getattr(self, attribute), key: value}),
+            )
+
+    def _graph_json(self, graphs):
+        return {host: _graph(snapshot) for host, snapshot in graphs.items()}
+
+    def _containers_json(self, records):
+        return {
+            str(name): {
+                "recent_status": [s for s in view.recent_status if s is not None],
+                "pending": view.pending,
+                "after": [str(a) for a in view.after],
+                "running": view.running,
+                "outcome": view.outcome,
+                "done_at": view.done_at,
+            }
+            for name, view in (records or {}).items()
+        }
+
+    def _checks_json(self, checks, plans):
+        hosts = {}
+        for (host, kind), check in checks.items():
+            hosts.setdefault(host, {})[kind] = check._asdict()
+        for host, (timestamp, plan) in plans.items():
+            hosts.setdefault(host, {})["plan"] = {"at": timestamp, "waves": plan}
+        return hosts
+
+    def _limits_json(self, limits, global_tokens):
+        return {
+            "global_tokens": _round(global_tokens),
+            "containers": {
+                key: {
+                    "restarts": list(limit.restarts),
+                    "tokens": _round(limit.tokens),
+                    "parked_until": limit.parked_until,
+                }
+                for key, limit in (limits or {}).items()
+            },
+        }
+
+
+def _round(tokens):
+    return round(tokens, 2) if tokens is not None else None
+
+
+def _graph(snapshot):
+    containers = {}
+    for row, name in enumerate(snapshot.names):
+        flags = snapshot.flags[row]
+        containers[name] = {
+            "status": state.STATUSES[snapshot.status[row]],
+            "health": state.HEALTHS[snapshot.health[row]] or None,
+            "started_at": snapshot.started_at[row] / 1e9,
+            "enabled": bool(flags & state.ENABLED),
+            "policy": [
+                policy
+                for policy, bit in (
+                    ("dependency", state.DEPENDENCY),
+                    ("unhealthy", state.UNHEALTHY_POLICY),
+                )
+                if flags & bit
+            ],
+            "depends_on": (
+                [
+                    snapshot.names[parent]
+                    for parent in snapshot.parents[
+                        snapshot.offsets[row] : snapshot.offsets[row + 1]
+                    ]
+                ]
+                if row in snapshot.targets
+                else []
+            ),
+        }
+    return containers
+
+
+board = Board()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if (body := board.render(self.path)) is None:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port):
+    server = ThreadingHTTPServer(("", port), _Handler)
+    threading.Thread(name="status", target=server.serve_forever, daemon=True).start()
+    logging.info(f"Serving the status API on port {port}.")
@@ -0,0 +1,32 @@
+import asyncio
+
+import pytest
+
+import restarter.aio as aio
+import restarter.docker_utils as docker_utils
+import restarter.hosts as hosts
+from bench import fake_docker
+
+
+@pytest.fixture
+def daemon(tmp_path):
+    daemon = fake_docker.Daemon()
+    server = fake_docker.serve(daemon, str(tmp_path / "docker.sock"))
+    daemon.add("app")
+    yield daemon
+    server.shutdown()
+
+
+def test_resync_retries_server_errors(daemon, tmp_path, monkeypatch):
+    monkeypatch.setattr(docker_utils, "backoff", lambda attempt: 0)
+    host = hosts.Host("local", f"unix://{tmp_path}/docker.sock", qualified=False)
+    engine = aio.Engine(host, None, None)
+    engine.http = aio.UnixHTTPClient(
+        aio.socket_path(host.url), host.client.api.api_version, host.name
+    )
+    daemon.failures["GET /containers/json"] = 2
+
+    asyncio.run(engine.resync())
+
+    assert daemon.calls["GET /containers/json"] == 3
+    assert [c.name for c in host.store.containers()] == ["app"]
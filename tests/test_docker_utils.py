@@ -0,0 +1,54 @@
+import docker
+import pytest
+
+import restarter.docker_utils as docker_utils
+from bench import fake_docker
+
+
+@pytest.fixture
+def daemon(tmp_path):
+    daemon = fake_docker.Daemon()
+    server = fake_docker.serve(daemon, str(tmp_path / "docker.sock"))
+    yield daemon
+    server.shutdown()
+
+
+@pytest.fixture
+def client(daemon, tmp_path):
+    return docker_utils.connect(f"unix://{tmp_path}/docker.sock", "local")
+
+
+def recreate(daemon, client):
+    vpn = daemon.add("vpn")
+    daemon.add("app", network_mode="container:gone")
+    return docker_utils.recreate(
+        client,
+        client.containers.get("app"),
+        {"image": "alpine", "network_mode": f"container:{vpn}"},
+    )
+
+
+def names(daemon):
+    return sorted(c["Name"][1:] for c in daemon.containers.values())
+
+
+def test_recreate(daemon, client):
+    recreated, _ = recreate(daemon, client)
+    assert names(daemon) == ["app", "vpn"]
+    assert daemon.find("app")["Id"] == recreated.id
+    assert daemon.find("app")["State"]["Running"]
+
+
+def test_recreate_under_the_name_if_rename_fails(daemon, client):
+    daemon.failures["POST /containers/{id}/rename"] = 1
+    recreated, _ = recreate(daemon, client)
+    assert names(daemon) == ["app", "vpn"]
+    assert daemon.find("app")["Id"] == recreated.id
+    assert daemon.find("app")["State"]["Running"]
+
+
+def test_no_replacement_left_if_remove_fails(daemon, client):
+    daemon.failures["DELETE /containers/{id}"] = 1
+    with pytest.raises(docker.errors.APIError):
+        recreate(daemon, client)
+    assert names(daemon) == ["app", "vpn"]
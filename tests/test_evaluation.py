@@ -0,0 +1,133 @@
+import random
+from datetime import datetime
+
+import pytest
+from docker.models.containers import Container
+
+import restarter.config as config
+import restarter.evaluation as evaluation
+import restarter.state as state
+from bench import fake_docker, scenarios
+
+
+def reference(store, ids=None):
+    """The findings of the per-container evaluation the columns replaced."""
+    if ids is None:
+        containers = store.containers()
+    else:
+        containers = store.neighbourhood(ids)
+
+    findings = set()
+    for container in containers:
+        settings = config.from_labels(container.labels)
+        if not settings[config.Setting.ENABLE]:
+            continue
+
+        if (
+            config.Policy.UNHEALTHY in settings[config.Setting.POLICY]
+            and container.attrs["State"].get("Health", {}).get("Status", "")
+            == "unhealthy"
+        ):
+            findings.add((evaluation.UNHEALTHY, container.name, None))
+
+        if config.Policy.DEPENDENCY in settings[config.Setting.POLICY]:
+            started_at = datetime.fromisoformat(
+                container.attrs["State"]["StartedAt"]
+            ).timestamp()
+            for dependency in store.parents(container.id):
+                if (
+                    dependency.attrs["State"].get("Health", {}).get("Status", "")
+                    == "unhealthy"
+                    or dependency.attrs["State"]["Status"] != "running"
+                ):
+                    findings.add(
+                        (evaluation.DEPENDENCY_DOWN, container.name, dependency.name)
+                    )
+
+                dependency_started_at = datetime.fromisoformat(
+                    dependency.attrs["State"]["StartedAt"]
+                ).timestamp()
+                if started_at <= dependency_started_at:
+                    findings.add(
+                        (evaluation.STARTED_BEFORE, container.name, dependency.name)
+                    )
+
+    return findings
+
+
+@pytest.fixture
+def workers(monkeypatch):
+    monkeypatch.setitem(
+        config.global_settings, config.GlobalSetting.EVALUATION_WORKERS, 2
+    )
+    monkeypatch.setattr(evaluation, "SHARD_MIN_TARGETS", 0)
+    evaluation.start()
+    yield
+    evaluation._pool.shutdown()
+    evaluation._pool = None
+
+
+def fuzz(trials=200, seed=1):
+    """Mutates a store at random, yielding it and some ids after each mutation."""
+    rng = random.Random(seed)
+    daemon = fake_docker.Daemon()
+    scenarios.get("projects-300").setup(daemon)
+    for i in range(50):
+        project, service = rng.randrange(30), rng.randrange(10)
+        daemon.add(
+            f"x{i}",
+            labels={
+                "restarter.depends_on": f"container:p{project}-s{service}",
+                "restarter.policy": rng.choice(
+                    ["dependency", "unhealthy", "dependency,unhealthy"]
+                ),
+                "restarter.enable": rng.choice(["yes", "yes", "no"]),
+            },
+            health=True,
+        )
+    containers = [Container(attrs=c) for c in daemon.containers.values()]
+    store = state.Store(None, None)
+    store.replace(containers)
+
+    for trial in range(trials):
+        i = rng.randrange(len(containers))
+        attrs = containers[i].attrs
+        status = dict(
+            attrs["State"], Status=rng.choice(["running", "exited", "running"])
+        )
+        if "Health" in status:
+            status["Health"] = {
+                "Status": rng.choice(["healthy", "unhealthy", "starting"])
+            }
+        if rng.random() < 0.3:
+            status["StartedAt"] = fake_docker._iso(rng.uniform(1.7e9, 1.8e9))
+        containers[i] = Container(attrs={**attrs, "State": status})
+        store.put(containers[i])
+        if trial % 17 == 0:
+            id = daemon.add(
+                f"n{trial}",
+                labels={"restarter.depends_on": "container:x1"},
+                status="exited",
+            )
+            containers.append(Container(attrs=daemon.containers[id]))
+            store.put(containers[-1])
+        if trial % 23 == 0:
+            store.remove(containers.pop(rng.randrange(len(containers))).id)
+        if trial % 50 == 0:
+            store.replace(list(containers))
+        yield store, [rng.choice(containers).id for _ in range(3)]
+
+
+def check(store, ids):
+    assert set(evaluation.evaluate(store.snapshot())) == reference(store)
+    assert set(evaluation.evaluate(store.snapshot(ids))) == reference(store, ids)
+
+
+def test_equivalent_to_reference():
+    for store, ids in fuzz():
+        check(store, ids)
+
+
+def test_equivalent_to_reference_with_workers(workers):
+    for store, ids in fuzz(trials=50):
+        check(store, ids)
@@ -0,0 +1,100 @@
+import json
+import random
+
+import restarter.events as events
+
+STATUSES = [
+    "start",
+    "die",
+    "rename",
+    "health_status: healthy",
+    "health_status: unhealthy",
+    "exec_start: sh -c true",
+    "destroy",
+    "update",
+    "attach",
+]
+
+# Labels which look like the keys the decoder picks once encoded
+TRICKY_LABELS = {
+    'x"name': '","name":"evil',
+    "scope": '},"scope":',
+    "é\\": 'ünï"\\',
+    "oldName2": "z",
+    "name2": '{"name":"',
+}
+
+
+def event(rng, i):
+    status = rng.choice(STATUSES)
+    attributes = {
+        "name": f"app{i}" + rng.choice(["", '"\\é', "\n"]),
+        **{f"com.example.ci.label{j}": "v" * 64 for j in range(rng.randrange(60))},
+    }
+    if rng.random() < 0.5:
+        attributes.update(TRICKY_LABELS)
+    if status == "rename":
+        attributes["oldName"] = f"/old{i}"
+    # In the order of the daemon's `Message` struct
+    return {
+        "status": status,
+        "id": f"{i:064x}",
+        "from": "img",
+        "Type": "container",
+        "Action": status,
+        "Actor": {"ID": f"{i:064x}", "Attributes": attributes},
+        "scope": "local",
+        "time": i,
+        "timeNano": i * 10**9 + 7,
+    }
+
+
+def encode(rng, event):
+    """Encodes `event` as the daemon does most of the time, or in another way."""
+    compact = rng.random() < 0.8
+    text = json.dumps(
+        event,
+        ensure_ascii=rng.random() < 0.5,
+        separators=(",", ":") if compact else None,
+    )
+    return text.encode() + b"\n", compact
+
+
+def expected(event, line, compact):
+    if not compact or len(line) < events.FULL_DECODE_BELOW:
+        return event
+    attributes = event["Actor"]["Attributes"]
+    picked = {k: attributes[k] for k in ("name", "oldName") if k in attributes}
+    return {**event, "Actor": {**event["Actor"], "Attributes": picked}}
+
+
+def test_decoder_equivalent_to_json():
+    rng = random.Random(3)
+    data, want = b"", []
+    for i in range(2000):
+        e = event(rng, i)
+        line, compact = encode(rng, e)
+        data += line + (b"\n" if rng.random() < 0.05 else b"")
+        if e["status"].partition(":")[0] in events.CONTAINER_EVENTS:
+            want.append(expected(e, line, compact))
+    assert any(len(e["Actor"]["Attributes"]) <= 2 for e in want)
+    assert any(len(e["Actor"]["Attributes"]) > 2 for e in want)
+
+    decoder, got, start = events.Decoder(), [], 0
+    while start < len(data):
+        stop = start + rng.choice([1, 97, 4096, 65536])
+        got += decoder.feed(data[start:stop])
+        start = stop
+    assert got == want
+
+
+def test_decoder_whole_lines():
+    rng = random.Random(4)
+    lines = [encode(rng, event(rng, i)) for i in range(200)]
+    decoder = events.Decoder(statuses=("start",))
+    got = decoder.feed(b"".join(line for line, _ in lines))
+    assert got == [
+        expected(json.loads(line), line, compact)
+        for line, compact in lines
+        if json.loads(line)["status"] == "start"
+    ]
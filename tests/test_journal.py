@@ -0,0 +1,39 @@
+import time
+from types import SimpleNamespace
+
+from docker.models.containers import Container
+
+import restarter.hosts as hosts
+import restarter.journal as journal_
+import restarter.limits as limits
+import restarter.state as state
+from bench import fake_docker
+
+
+def test_only_counted_restarts_are_journaled(tmp_path):
+    daemon = fake_docker.Daemon()
+    daemon.add("app", started_at=time.time() - 60)
+    store = state.Store(None, None)
+    store.replace([Container(attrs=c) for c in daemon.containers.values()])
+    limiter = limits.Limiter(None)
+    journal = journal_.Journal(str(tmp_path / "journal"))
+    ref = hosts.Ref(SimpleNamespace(name="local", qualified=False), "app")
+
+    def gate(timestamp):
+        return limiter.gate(
+            store,
+            "app",
+            timestamp,
+            restarted=lambda at: journal.restarted(ref, at),
+        )
+
+    # Already restarted since the request, nothing to count
+    assert gate(time.time() - 120) is None
+    assert not journal.state().history
+    assert "app" not in limiter.limits
+
+    assert gate(time.time() - 30) is None
+    [at] = limiter.limits["app"].restarts
+    assert journal_.Journal(str(tmp_path / "journal")).state().history == {
+        ("local", "app"): [at]
+    }
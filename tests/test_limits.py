@@ -0,0 +1,111 @@
+from types import SimpleNamespace
+
+import pytest
+
+import restarter.config as config
+import restarter.limits as limits
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(limits, "time", SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+def settings(**labels):
+    return config.from_labels({f"restarter.{k}": v for k, v in labels.items()})
+
+
+def test_unlimited_by_default(clock):
+    limiter = limits.Limiter(None)
+    for _ in range(20):
+        assert limiter.acquire("app", settings()) is None
+    assert len(limiter.limits["app"].restarts) == 20
+
+
+def test_backoff_doubles_up_to_max(clock):
+    limiter = limits.Limiter(None)
+    app = settings(backoff="10", backoff_max="25")
+    assert limiter.acquire("app", app) is None
+    assert limiter.acquire("app", app) == 1010
+    clock.now = 1010
+    assert limiter.acquire("app", app) is None
+    assert limiter.acquire("app", app) == 1030
+    clock.now = 1030
+    assert limiter.acquire("app", app) is None
+    # 40 seconds, capped
+    assert limiter.acquire("app", app) == 1055
+
+
+def test_rate_limit(clock):
+    limiter = limits.Limiter(None)
+    app = settings(rate_limit="2/60")
+    assert limiter.acquire("app", app) is None
+    assert limiter.acquire("app", app) is None
+    assert limiter.acquire("app", app) == pytest.approx(1030)
+    clock.now = 1030
+    assert limiter.acquire("app", app) is None
+    # Other containers have buckets of their own
+    assert limiter.acquire("other", app) is None
+
+
+def test_global_rate_limit(clock):
+    limiter = limits.Limiter(config.Rate(1, 10))
+    assert limiter.acquire("app", settings()) is None
+    assert limiter.acquire("other", settings()) == pytest.approx(1010)
+    assert limiter.global_tokens == pytest.approx(0)
+
+
+def test_circuit_breaker_parks_and_releases(clock):
+    limiter = limits.Limiter(None)
+    app = settings(circuit_breaker="3/100")
+    for i in range(3):
+        clock.now = 1000 + i
+        assert limiter.acquire("app", app) is None
+    clock.now = 1010
+    # Parked for the window, from the last restart
+    assert limiter.acquire("app", app) == 1102
+    assert limiter.limits["app"].parked_until == 1102
+    assert limiter.parked() == 1
+    clock.now = 1050
+    assert limiter.acquire("app", app) == 1102
+
+    clock.now = 1102
+    assert limiter.acquire("app", app) is None
+    # The restarts before parking don't count anymore
+    assert limiter.limits["app"].restarts == (1102,)
+    assert limiter.parked() == 0
+
+
+def test_restarts_expire_from_the_window(clock):
+    limiter = limits.Limiter(None)
+    app = settings(circuit_breaker="2/100")
+    assert limiter.acquire("app", app) is None
+    clock.now = 1101
+    assert limiter.acquire("app", app) is None
+    assert limiter.acquire("app", app) is None
+    assert limiter.limits["app"].restarts == (1101, 1101)
+
+
+def test_forget_once_expired(clock):
+    limiter = limits.Limiter(None)
+    app = settings(circuit_breaker="1/100")
+    assert limiter.acquire("app", app) is None
+    assert limiter.acquire("app", app) == 1100
+
+    # Parked, kept in case it comes back under the same name
+    limiter.forget("app")
+    assert "app" in limiter.limits
+    assert limiter.acquire("app", app) == 1100
+
+    limiter.forget("app")
+    clock.now = 1100
+    limiter.forget("other")
+    assert "app" not in limiter.limits
+
+
+def test_restore(clock):
+    limiter = limits.Limiter(None)
+    limiter.restore("app", [990, 980])
+    assert limiter.acquire("app", settings(circuit_breaker="2/100")) == 1090
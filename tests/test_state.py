@@ -0,0 +1,62 @@
+import time
+
+from docker.models.containers import Container
+
+import restarter.evaluation as evaluation
+import restarter.state as state
+from bench import fake_docker
+
+
+def seeded():
+    daemon = fake_docker.Daemon()
+    daemon.add("vpn")
+    time.sleep(0.01)
+    daemon.add("child", labels={"restarter.depends_on": "container:vpn"})
+    store = state.Store(None, None)
+    store.replace([Container(attrs=c) for c in daemon.containers.values()])
+    return daemon, store
+
+
+def listing(daemon):
+    return [daemon.summary(c) for c in daemon.containers.values()]
+
+
+def test_replace_keeps_what_changed_meanwhile():
+    daemon, store = seeded()
+    summaries = listing(daemon)
+    fresh, stale, since = store.diff(summaries)
+    listed = fresh + [Container(attrs=daemon.containers[id]) for id in stale]
+
+    # Restarted, and refreshed, while the resync inspected the others
+    child = daemon.find("child")
+    restarted = {
+        **child,
+        "State": {**child["State"], "StartedAt": fake_docker._iso(time.time() + 1)},
+    }
+    store.put(Container(attrs=restarted))
+
+    assert not store.replace(listed, since)
+    assert store.find("child").attrs["State"] == restarted["State"]
+    assert not evaluation.evaluate(store.snapshot())
+
+
+def test_replace_keeps_what_was_removed_meanwhile():
+    daemon, store = seeded()
+    fresh, stale, since = store.diff(listing(daemon))
+    listed = fresh + [Container(attrs=daemon.containers[id]) for id in stale]
+    store.remove(daemon.find("child")["Id"])
+
+    assert not store.replace(listed, since)
+    assert store.find("child") is None
+
+
+def test_replace_without_changes_meanwhile_corrects_drift():
+    daemon, store = seeded()
+    fresh, stale, since = store.diff(listing(daemon))
+    listed = fresh + [Container(attrs=daemon.containers[id]) for id in stale]
+    store.remove(daemon.find("child")["Id"])
+    fresh, stale, since = store.diff(listing(daemon))
+    listed = fresh + [Container(attrs=daemon.containers[id]) for id in stale]
+
+    assert store.replace(listed, since)
+    assert store.find("child") is not None